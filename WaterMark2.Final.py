@@ -1,106 +1,2366 @@
+import io
 import os
 import sys
+import json
+import math
+import shutil
+import hashlib
+import struct
+import time
+import argparse
+import multiprocessing
+import functools
+import threading
+import platform
+import contextlib
+import cProfile
+import pstats
+import queue
+from collections import OrderedDict, Counter
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass, field
 import tkinter as tk
 from tkinter import filedialog, ttk, messagebox, colorchooser
+from tkinter import font as tkfont
 from PIL import Image, ImageDraw, ImageFont, ImageTk
 import piexif
+import numpy as np
 from matplotlib.font_manager import findSystemFonts, FontProperties, findfont
 from tkinterdnd2 import DND_FILES, TkinterDnD
 
+SUPPORTED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.gif', '.webp')
+
 # 核心函数
-def get_exif_date(img_path):
+def _get_exif_date_full(img_src):
     try:
-        exif_dict = piexif.load(img_path)
+        exif_dict = piexif.load(img_src)
         date_str = exif_dict['Exif'][piexif.ExifIFD.DateTimeOriginal].decode()
         date = date_str.split(' ')[0].replace(':', '.')
         return date
     except Exception:
         return None
 
-def add_watermark(img_path, text, font_path, font_size, color, alpha, pos_x, pos_y, style, outline_color):
+class _HeaderReader:
+    """按需从文件开头读取字节，只读到解析所需的位置为止。"""
+    def __init__(self, f, data=b""):
+        self.f = f
+        self.data = data
+
+    def need(self, end):
+        if end > len(self.data) and self.f is not None:
+            self.data += self.f.read(max(end - len(self.data), 4096))
+        if end > len(self.data):
+            raise ValueError("EXIF 数据不完整")
+        return self.data
+
+def _ifd_find(reader, tiff_start, endian, ifd_offset, wanted_tag):
+    """在 TIFF IFD 中查找标签，返回 (类型, 个数, 值字段的绝对偏移)。"""
+    base = tiff_start + ifd_offset
+    count, = struct.unpack(endian + "H", reader.need(base + 2)[base:base + 2])
+    data = reader.need(base + 2 + count * 12)
+    for i in range(count):
+        entry = base + 2 + i * 12
+        tag, value_type, value_count = struct.unpack(endian + "HHI", data[entry:entry + 8])
+        if tag == wanted_tag:
+            return value_type, value_count, entry + 8
+    return None
+
+def _locate_exif_segment(reader):
+    """扫描 JPEG 标记，返回 APP1(Exif) 段中 "Exif\\0\\0" 的起止偏移；没有时返回 None。"""
+    if reader.need(2)[:2] != b"\xff\xd8":
+        raise ValueError("不是 JPEG 文件")
+    pos = 2
+    while True:
+        data = reader.need(pos + 4)
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:  # 填充字节
+            pos += 1
+            continue
+        if marker in (0xD9, 0xDA):  # 图像数据开始，之后不会再有 APP1
+            return None
+        segment_len, = struct.unpack(">H", data[pos + 2:pos + 4])
+        if marker == 0xE1 and reader.need(pos + 10)[pos + 4:pos + 10] == b"Exif\0\0":
+            return pos + 4, pos + 2 + segment_len
+        pos += 2 + segment_len
+
+def read_exif_segment(img_path):
+    """只读取 JPEG 文件头中的 Exif 段原始字节（可直接传给 save(exif=...)），没有时返回 None。"""
+    try:
+        with open(img_path, "rb") as f:
+            reader = _HeaderReader(f)
+            located = _locate_exif_segment(reader)
+            return bytes(reader.need(located[1])[located[0]:located[1]]) if located else None
+    except (OSError, ValueError):
+        return None
+
+def read_exif_date_fast(f):
     """
-    为图片添加水印的核心函数。
-    - 修复了文件句柄未释放导致多次保存失败的Bug。
+    只解析 JPEG 开头的 APP1(Exif) 段，读取 DateTimeOriginal（通常只需读前几 KB）。
+    f 为以二进制方式打开的文件或字节串。不是 JPEG 时抛出 ValueError，没有拍摄日期时返回 None。
     """
-    exif_data = None
-    is_jpg = img_path.lower().endswith((".jpg", ".jpeg"))
-    is_png = img_path.lower().endswith(".png")
-    # 仅对jpeg/jpg文件尝试加载EXIF信息
-    if is_jpg:
-        try:
-            exif_data = piexif.load(img_path)
-        except Exception as e:
-            print(f"警告：无法加载 {os.path.basename(img_path)} 的EXIF信息: {e}")
+    reader = _HeaderReader(None, f) if isinstance(f, (bytes, bytearray)) else _HeaderReader(f)
+    located = _locate_exif_segment(reader)
+    if located is None:
+        return None
 
-    # --- 核心修复：使用 with 语句确保文件句柄被正确关闭 ---
-    with Image.open(img_path) as img_file:
-        img = img_file.convert("RGBA")
+    tiff_start = located[0] + 6
+    data = reader.need(tiff_start + 8)
+    endian = {b"II": "<", b"MM": ">"}.get(bytes(data[tiff_start:tiff_start + 2]))
+    if endian is None:
+        raise ValueError("无效的 TIFF 头")
+    ifd0_offset, = struct.unpack(endian + "I", data[tiff_start + 4:tiff_start + 8])
+    exif_pointer = _ifd_find(reader, tiff_start, endian, ifd0_offset, 0x8769)
+    if exif_pointer is None:
+        return None
+    exif_offset, = struct.unpack(endian + "I", reader.data[exif_pointer[2]:exif_pointer[2] + 4])
+    entry = _ifd_find(reader, tiff_start, endian, exif_offset, piexif.ExifIFD.DateTimeOriginal)
+    if entry is None:
+        return None
+    _, value_count, value_field = entry
+    if value_count > 4:
+        value_field = tiff_start + struct.unpack(endian + "I", reader.data[value_field:value_field + 4])[0]
+    raw = reader.need(value_field + value_count)[value_field:value_field + value_count]
+    date_str = bytes(raw).split(b"\0")[0].decode()
+    return date_str.split(' ')[0].replace(':', '.') or None
 
-    width, height = img.size
+_EXIF_DATE_CACHE = {}  # path -> ((mtime_ns, size), date)
+_EXIF_DATE_CACHE_LOCK = threading.Lock()
 
+def get_exif_date(img_src):
+    """
+    读取拍摄日期（YYYY.MM.DD）。JPEG 只解析文件头，结果按路径和修改时间缓存；
+    其它格式或文件头解析失败时回退到 piexif 完整解析。
+    """
+    if not isinstance(img_src, (str, os.PathLike)):
+        try: return read_exif_date_fast(bytes(img_src))
+        except Exception: return _get_exif_date_full(bytes(img_src))
+
+    img_path = os.fspath(img_src)
     try:
-        font = ImageFont.truetype(font_path, font_size)
+        st = os.stat(img_path)
+    except OSError:
+        return None
+    signature = (st.st_mtime_ns, st.st_size)
+    with _EXIF_DATE_CACHE_LOCK:
+        cached = _EXIF_DATE_CACHE.get(img_path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    try:
+        with open(img_path, "rb") as f: date = read_exif_date_fast(f)
+    except Exception:
+        date = _get_exif_date_full(img_path)
+    with _EXIF_DATE_CACHE_LOCK:
+        _EXIF_DATE_CACHE[img_path] = (signature, date)
+    return date
+
+def prefetch_exif_dates(paths, max_workers=8):
+    """用线程池并行读取一批图片的拍摄日期并写入缓存，返回 {路径: 日期}。"""
+    paths = list(paths)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return dict(zip(paths, executor.map(get_exif_date, paths)))
+
+@functools.lru_cache(maxsize=None)
+def get_font_path(font_name):
+    try: prop = FontProperties(family=font_name); return findfont(prop)
+    except Exception: return "arial.ttf"
+
+def parse_color(color_str):
+    """把 "255,255,255" 形式的颜色字符串解析为 RGB 元组。"""
+    return tuple(map(int, color_str.split(',')))
+
+# --- 字体与水印图章缓存：批量处理和监视模式下避免每张图重复加载字体、重复绘制文字 ---
+@functools.lru_cache(maxsize=64)
+def load_font(font_path, font_size):
+    try:
+        return ImageFont.truetype(font_path, font_size)
     except IOError:
-        font = ImageFont.load_default()
+        return ImageFont.load_default()
+
+_MEASURE_DRAW = ImageDraw.Draw(Image.new("RGBA", (0, 0)))
+
+@dataclass(frozen=True)
+class TextLayout:
+    """
+    文字在 (0, 0) 处绘制时的排版结果，预览、拖拽和导出共用。
+    bbox 是 Pillow 的排版框（右侧包含字符步进宽度），用于确定图章大小；
+    ink 是实际栅格化后的墨迹范围（相对绘制原点），用于对齐；多行文字按整体的墨迹范围对齐。
+    """
+    bbox: tuple
+    ink: tuple
+
+@functools.lru_cache(maxsize=256)
+def text_layout(text, font_path, font_size):
+    """按 (文字, 字体, 字号) 缓存排版结果，避免每次渲染、每次拖拽都重新测量。"""
+    font = load_font(font_path, font_size)
+    bbox = _MEASURE_DRAW.textbbox((0, 0), text, font=font)
+    # 在刚好容纳排版框的灰度图上绘制一次，取实际墨迹范围
+    origin_x, origin_y = 2 - math.floor(bbox[0]), 2 - math.floor(bbox[1])
+    mask = Image.new("L", (math.ceil(bbox[2]) + origin_x + 2, math.ceil(bbox[3]) + origin_y + 2))
+    ImageDraw.Draw(mask).text((origin_x, origin_y), text, font=font, fill=255)
+    ink = mask.getbbox()
+    ink = (ink[0] - origin_x, ink[1] - origin_y, ink[2] - origin_x, ink[3] - origin_y) if ink else bbox
+    return TextLayout(bbox, ink)
+
+def measure_text(text, font_path, font_size):
+    """返回文字在 (0, 0) 处绘制时的 bbox。"""
+    return text_layout(text, font_path, font_size).bbox
+
+def _draw_watermark_text(draw, pos, text, font, fill_color, style, outline_fill):
+    if style == "阴影":
+        shadow_pos = (pos[0] + 2, pos[1] + 2)
+        draw.text(shadow_pos, text, font=font, fill=(0, 0, 0, 128))
 
-    txt_layer = Image.new("RGBA", img.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(txt_layer)
+    elif style == "描边":
+        for x_offset in [-1, 0, 1]:
+            for y_offset in [-1, 0, 1]:
+                if x_offset == 0 and y_offset == 0:
+                    continue
+                outline_pos = (pos[0] + x_offset, pos[1] + y_offset)
+                draw.text(outline_pos, text, font=font, fill=outline_fill)
+
+    draw.text(pos, text, font=font, fill=fill_color)
+
+_STAMP_PADDING = 3  # 覆盖描边(±1)、阴影(+2)和亚像素偏移
+
+@functools.lru_cache(maxsize=128)
+def render_stamp(text, font_path, font_size, color, alpha, style, outline_color, frac_x=0.0, frac_y=0.0):
+    """
+    把水印文字（含阴影/描边样式）栅格化为一张只有文字大小的透明图章。
+    返回 (stamp, origin_x, origin_y)：文字原点在图章中的整数坐标。
+    frac_x/frac_y 是落点的小数部分，保证与直接在整图上绘制的亚像素结果一致。
+    """
+    font = load_font(font_path, font_size)
+    left, top, right, bottom = measure_text(text, font_path, font_size)
+    # 描边向左/上偏移 1 像素后坐标也不能为负：Pillow 对负的小数坐标向零取整，亚像素落点会与整图绘制差一个像素
+    origin_x = max(1, _STAMP_PADDING - math.floor(left))
+    origin_y = max(1, _STAMP_PADDING - math.floor(top))
+    stamp_w = origin_x + math.ceil(right) + _STAMP_PADDING
+    stamp_h = origin_y + math.ceil(bottom) + _STAMP_PADDING
 
+    stamp = Image.new("RGBA", (stamp_w, stamp_h), (255, 255, 255, 0))
     fill_color = color + (int(alpha * 255 / 100),)
+    outline_fill = outline_color + (int(alpha * 255 / 100),)
+    _draw_watermark_text(ImageDraw.Draw(stamp), (origin_x + frac_x, origin_y + frac_y),
+                         text, font, fill_color, style, outline_fill)
+    return stamp, origin_x, origin_y
 
-    bbox = draw.textbbox((0, 0), text, font=font)
+def resolve_position(pos_x, pos_y, width, height, bbox):
+    """
+    把 pos_x/pos_y（-1 居中，-2 靠右/靠下，其它为绝对坐标）换算为文字的绘制坐标。
+    bbox 为墨迹范围（TextLayout.ink）：居中和靠右/靠下都减去字形偏移，靠右时墨迹右边缘距图片边缘 10 像素。
+    """
     text_w = bbox[2] - bbox[0]
     text_h = bbox[3] - bbox[1]
 
     if pos_x == -1: # 居中
-        x = (width - text_w) // 2
+        x = (width - text_w) // 2 - bbox[0]
     elif pos_x == -2: # 靠右
-        x = width - text_w - 10
+        x = width - 10 - bbox[2]
     else: # 左对齐或手动拖拽的绝对坐标
         x = pos_x
 
     if pos_y == -1: # 居中
-        y = (height - text_h) // 2
+        y = (height - text_h) // 2 - bbox[1]
     elif pos_y == -2: # 靠下
-        y = height - text_h - 10
+        y = height - 10 - bbox[3]
     else: # 靠上或手动拖拽的绝对坐标
         y = pos_y
+    return x, y
 
-    pos = (x, y)
+def clamp_position(x, y, width, height, bbox):
+    """
+    把绝对绘制坐标限制在墨迹不超出图片右/下边缘的范围内（拖拽时使用）。
+    下限为 0：负数是居中/靠右等锚点的标记，拖到左/上边缘时不能落在这些值上。
+    """
+    x = max(0, min(x, width - bbox[2]))
+    y = max(0, min(y, height - bbox[3]))
+    return x, y
 
-    if style == "阴影":
-        shadow_pos = (pos[0] + 2, pos[1] + 2)
-        draw.text(shadow_pos, text, font=font, fill=(0, 0, 0, 128))
+# --- 图章混合：只在图章覆盖的区域上用 NumPy 做定点整数运算 ---
+BLEND_MODES = ("正常", "正片叠底", "滤色")
+_PRECISION_BITS = 7  # 与 Pillow AlphaComposite.c 相同
 
-    elif style == "描边":
-        outline_fill = outline_color + (int(alpha * 255 / 100),)
-        for x_offset in [-1, 0, 1]:
-            for y_offset in [-1, 0, 1]:
-                if x_offset == 0 and y_offset == 0:
-                    continue
-                outline_pos = (pos[0] + x_offset, pos[1] + y_offset)
-                draw.text(outline_pos, text, font=font, fill=outline_fill)
+def _div255(a):
+    """四舍五入的 a / 255（a 为 uint32 数组，a <= 255 * 255）。"""
+    a = a + 128
+    return ((a >> 8) + a) >> 8
 
-    draw.text(pos, text, font=font, fill=fill_color)
-    watermarked_img = Image.alpha_composite(img, txt_layer)
+def composite_pixels(dst, src, blend_mode="正常"):
+    """
+    把 RGBA 图章像素 src 合成到 dst（RGB 或 RGBA，形状相同）上，返回新的 uint8 数组。
+    "正常" 模式逐位复现 Pillow 的 alpha_composite；RGB 目标按不透明（alpha=255）处理，
+    结果与先转 RGBA 合成再转回 RGB 完全一致。"正片叠底"/"滤色" 先按 W3C 合成规则混合颜色再合成。
+    """
+    src_a = src[..., 3].astype(np.uint32)
+    src_rgb = src[..., :3].astype(np.uint32)
+    dst_rgb = dst[..., :3].astype(np.uint32)
+    has_alpha = dst.shape[-1] == 4
+    dst_a = dst[..., 3].astype(np.uint32) if has_alpha else np.full(src_a.shape, 255, dtype=np.uint32)
+
+    if blend_mode != "正常":
+        product = _div255(dst_rgb * src_rgb)
+        mixed = product if blend_mode == "正片叠底" else dst_rgb + src_rgb - product
+        # 目标不透明时就是混合色本身；目标半透明时按目标 alpha 在原色和混合色之间插值
+        src_rgb = _div255((255 - dst_a)[..., None] * src_rgb + dst_a[..., None] * mixed)
+
+    blend = dst_a * (255 - src_a)
+    out_a255 = src_a * 255 + blend
+    coef1 = src_a * (255 * 255 << _PRECISION_BITS) // np.maximum(out_a255, 1)
+    coef2 = (255 << _PRECISION_BITS) - coef1
+    tmp = src_rgb * coef1[..., None] + dst_rgb * coef2[..., None] + (0x80 << _PRECISION_BITS)
+    out_rgb = (((tmp >> 8) + tmp) >> 8) >> _PRECISION_BITS
+
+    out = dst.copy()
+    covered = src_a > 0  # 完全透明的图章像素保持原样
+    out[..., :3][covered] = out_rgb[covered]
+    if has_alpha:
+        out_a = out_a255 + 0x80
+        out[..., 3][covered] = (((out_a >> 8) + out_a) >> 8)[covered]
+    return out
+
+def stamp_watermark(img, x, y, text, font_path, font_size, color, alpha, style, outline_color, blend_mode="正常"):
+    """
+    把水印图章合成到图片（RGB 或 RGBA）的 (x, y) 处。
+    只取出图章覆盖的区域交给 composite_pixels 计算再贴回，不会复制或转换整幅图片。
+    """
+    ix, iy = math.floor(x), math.floor(y)
+    stamp, origin_x, origin_y = render_stamp(text, font_path, font_size, color, alpha, style,
+                                             outline_color, x - ix, y - iy)
+    left, top = ix - origin_x, iy - origin_y
+    # 裁掉超出图片边界的部分
+    src_left, src_top = max(0, -left), max(0, -top)
+    src_right = min(stamp.width, img.width - left)
+    src_bottom = min(stamp.height, img.height - top)
+    if src_right <= src_left or src_bottom <= src_top:
+        return img
+    box = (left + src_left, top + src_top, left + src_right, top + src_bottom)
+    region = np.asarray(img.crop(box))
+    overlay = np.asarray(stamp)[src_top:src_bottom, src_left:src_right]
+    img.paste(Image.fromarray(composite_pixels(region, overlay, blend_mode), img.mode), box)
+    return img
+
+def _open_source(img_src):
+    """
+    统一文件路径、字节串和类文件对象三种输入。
+    返回 (可传给 Image.open/piexif.load 的对象, 显示用名称, 是否JPEG, 是否PNG)。
+    """
+    if isinstance(img_src, (str, os.PathLike)):
+        img_path = os.fspath(img_src)
+        return (img_path, os.path.basename(img_path),
+                img_path.lower().endswith((".jpg", ".jpeg")), img_path.lower().endswith(".png"))
+    data = img_src if isinstance(img_src, (bytes, bytearray, memoryview)) else img_src.read()
+    data = bytes(data)
+    return data, "<内存图片>", data[:2] == b"\xff\xd8", data[:8] == b"\x89PNG\r\n\x1a\n"
+
+def watermark_image(img, text, font_path, font_size, color, alpha, pos_x, pos_y, style, outline_color, blend_mode="正常"):
+    """在已解码的 RGBA（或 RGB）图片上原地添加水印并返回该图片。"""
+    x, y = resolve_position(pos_x, pos_y, img.width, img.height, text_layout(text, font_path, font_size).ink)
+    return stamp_watermark(img, x, y, text, font_path, font_size, color, alpha, style, outline_color, blend_mode)
 
+def add_watermark(img_src, text, font_path, font_size, color, alpha, pos_x, pos_y, style, outline_color, blend_mode="正常"):
+    """
+    为图片添加水印的核心函数。
+    - 修复了文件句柄未释放导致多次保存失败的Bug。
+    - 水印先栅格化为缓存的小图章，再只合成到文字所在区域。
+    - img_src 可以是文件路径、编码后的图片字节串或类文件对象。
+    """
+    img, exif_data, label, is_png = _decode_source(img_src)
+    watermarked_img = watermark_image(img, text, font_path, font_size, color, alpha, pos_x, pos_y, style, outline_color, blend_mode)
+    # 返回处理后的图片和EXIF数据
+    return _finish_output(watermarked_img, exif_data, label, is_png)
+
+def _decode_source(img_src):
+    """解码源图并读取 EXIF，返回 (图片, EXIF 字典或 None, 显示用名称, 是否PNG)。"""
+    exif_data = None
+    source, label, is_jpg, is_png = _open_source(img_src)
+    # 仅对jpeg/jpg文件尝试加载EXIF信息
+    if is_jpg:
+        try:
+            exif_data = piexif.load(source)
+        except Exception as e:
+            print(f"警告：无法加载 {label} 的EXIF信息: {e}")
+
+    # --- 核心修复：使用 with 语句确保文件句柄被正确关闭 ---
+    # 不透明的源图直接在 RGB 上合成，只有需要透明通道时才转为 RGBA，省去两次整图转换
+    with Image.open(source if isinstance(source, str) else io.BytesIO(source)) as img_file:
+        has_alpha = img_file.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in img_file.info
+        working_mode = "RGBA" if is_png or has_alpha else "RGB"
+        img = img_file.convert(working_mode) if img_file.mode != working_mode else img_file
+        img.load()
+    return img, exif_data, label, is_png
+
+def _finish_output(watermarked_img, exif_data, label, is_png):
+    """PNG 保留透明通道且不带 EXIF，其余转为 RGB 并打包 EXIF。返回 (图片, EXIF 字节串)。"""
     # PNG 保留透明通道，JPG转为RGB
     if is_png:
         final_img = watermarked_img  # 保持RGBA
         final_exif_bytes = None      # PNG不支持EXIF
     else:
-        final_img = watermarked_img.convert("RGB")
+        final_img = watermarked_img if watermarked_img.mode == "RGB" else watermarked_img.convert("RGB")
         final_exif_bytes = b''
         if exif_data:
             try:
                 final_exif_bytes = piexif.dump(exif_data)
             except Exception as e:
-                print(f"警告：无法打包 {os.path.basename(img_path)} 的EXIF信息: {e}")
-
-    # 返回处理后的图片和EXIF数据
+                print(f"警告：无法打包 {label} 的EXIF信息: {e}")
     return final_img, final_exif_bytes
 
-import json
+def build_output_name(fname, output_format, naming_rule, custom_text):
+    base_name, _ = os.path.splitext(fname)
+    if naming_rule == "添加前缀":
+        return f"{custom_text}{base_name}.{output_format}"
+    elif naming_rule == "添加后缀":
+        return f"{base_name}{custom_text}.{output_format}"
+    return f"{base_name}.{output_format}"
+
+@contextlib.contextmanager
+def _atomic_output(out):
+    """
+    out 为路径时先让调用方写入同目录下的临时文件，成功后再 os.replace 到 out；
+    从不原地截断已有文件（它可能与别处共用 inode），写到一半失败也不会留下残缺的输出。
+    out 为类文件对象时原样交给调用方。
+    """
+    if not isinstance(out, (str, os.PathLike)):
+        yield out
+        return
+    tmp = f"{os.fspath(out)}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield tmp
+        os.replace(tmp, out)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+
+# 输出格式 -> (Pillow 格式名, 保存前需要转换的模式, 是否写入 EXIF)
+_ENCODERS = {
+    "jpg": ("jpeg", "RGB", True),   # JPEG 不支持透明通道
+    "jpeg": ("jpeg", "RGB", True),
+    "png": ("png", None, False),    # PNG 保持RGBA，不能带exif
+}
+
+def encoder_for(output_format):
+    """返回输出格式的编码参数 (格式名, 模式, 是否写入 EXIF)，未列出的格式按原样保存。"""
+    output_format = output_format.lower()
+    return _ENCODERS.get(output_format, (output_format, None, False))
+
+def save_watermarked(watermarked_img, exif_bytes, out_path, output_format, encoder=None):
+    # --- 核心修复：根据格式和EXIF数据进行保存 ---
+    # encoder 为渲染计划中预先解析的编码参数，省略时按 output_format 查表
+    format_name, mode, with_exif = encoder or encoder_for(output_format)
+    with _atomic_output(out_path) as target:
+        if mode and watermarked_img.mode != mode:
+            watermarked_img = watermarked_img.convert(mode)
+        if with_exif and exif_bytes:
+            watermarked_img.save(target, format=format_name, exif=exif_bytes)
+        else:
+            watermarked_img.save(target, format=format_name)
+
+# --- 渲染计划：设置在批处理开始前编译一次，之后每张图片直接使用 ---
+# --- 自适应：相对字号和自动选择最不杂乱的角 ---
+AUTO_POSITION = "auto"  # pos_x/pos_y 为 "auto" 时自动选择位置；不用数字，以免与拖拽得到的坐标冲突
+_STATS_EDGE = 256   # 统计用亮度图的长边
+_AUTO_MARGIN = 10   # 与靠左/靠上的默认边距一致
+
+def luminance_proxy(img):
+    """
+    从已解码的图片（或代理图）按最近邻抽样得到长边约 256 像素的灰度图，
+    只读取约 1/N² 的像素，不对全分辨率图片做任何统计。
+    """
+    scale = _STATS_EDGE / max(img.size)
+    if scale < 1:
+        img = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))), Image.NEAREST)
+    return img.convert("L")
+
+def jpeg_luminance_proxy(img_path):
+    """JPEG 按 1/8 DCT 缩放只解码亮度分量，不解码全分辨率图片；其它格式返回 None。"""
+    with _open_unchecked(img_path) as img:
+        if img.format != "JPEG": return None
+        img.draft("L", (img.width // 8, img.height // 8))
+        return luminance_proxy(img)
+
+def least_busy_position(luminance, width, height, ink, color, pos_x=AUTO_POSITION, pos_y=AUTO_POSITION):
+    """
+    在各候选角（pos_x/pos_y 为 "auto" 的方向在靠左/靠右、靠上/靠下中选择）上计算水印区域的亮度标准差，
+    并对与文字颜色亮度接近（对比度低）的区域加罚分，返回得分最低的 (pos_x, pos_y)。
+    luminance 是缩小后的灰度图，坐标按比例换算。同分时依次优先右下、左下、右上、左上。
+    """
+    xs = (-2, _AUTO_MARGIN) if pos_x == AUTO_POSITION else (pos_x,)
+    ys = (-2, _AUTO_MARGIN) if pos_y == AUTO_POSITION else (pos_y,)
+    pixels = np.asarray(luminance, dtype=np.float32)
+    sx, sy = luminance.width / width, luminance.height / height
+    text_luma = 0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]
+    best, best_score = (xs[0], ys[0]), None
+    for cy in ys:
+        for cx in xs:
+            x, y = resolve_position(cx, cy, width, height, ink)
+            left = max(0, math.floor((x + ink[0] - _AUTO_MARGIN) * sx)); right = min(luminance.width, math.ceil((x + ink[2] + _AUTO_MARGIN) * sx))
+            top = max(0, math.floor((y + ink[1] - _AUTO_MARGIN) * sy)); bottom = min(luminance.height, math.ceil((y + ink[3] + _AUTO_MARGIN) * sy))
+            region = pixels[top:max(bottom, top + 1), left:max(right, left + 1)]
+            if region.size == 0: continue
+            score = float(region.std()) + max(0.0, 80.0 - abs(float(region.mean()) - text_luma))
+            if best_score is None or score < best_score:
+                best, best_score = (cx, cy), score
+    return best
+
+WATERMARK_STYLES = ("无", "阴影", "描边")
+OUTPUT_FORMATS = ("jpg", "jpeg", "png")
+_PLAN_KEYS = ("text", "font_name", "font_size", "text_color", "outline_color", "alpha", "style", "pos_x", "pos_y")
+_PLAN_DEFAULTS = {"blend_mode": "正常"}  # 旧模板中没有的字段及其默认值
+
+@dataclass(frozen=True)
+class RenderPlan:
+    """
+    由设置字典编译得到的不可变渲染计划：字体路径、颜色、位置规则、输出格式和编码参数都已解析并校验。
+    相同的设置只编译一次（按设置内容缓存）；传给工作进程时只传设置本身，进程内重新命中缓存。
+    """
+    text: str
+    font_name: str
+    font_path: str
+    font_size: int
+    font_scale: float  # 相对字号（短边的比例），0 表示 font_size 为绝对像素值
+    color: tuple
+    outline_color: tuple
+    alpha: float
+    style: str
+    pos_x: float
+    pos_y: float
+    blend_mode: str
+    output_format: str
+    encoder: tuple = field(compare=False)  # encoder_for(output_format)，保存时直接使用
+    key: tuple = field(compare=False, repr=False)
+
+    def __reduce__(self):
+        return (_compile_render_plan, (self.key, self.output_format))
+
+    def resolve_text(self, img_src):
+        """返回实际要绘制的文本；"使用拍摄日期" 换成图片的拍摄日期（没有时为空串）。"""
+        if self.text == "使用拍摄日期": return get_exif_date(img_src) or ""
+        return self.text
+
+    @property
+    def adaptive(self):
+        """字号或位置取决于具体图片，使用前需先用 for_image 换算为具体的计划。"""
+        return bool(self.font_scale) or AUTO_POSITION in (self.pos_x, self.pos_y)
+
+    def font_size_for(self, width, height):
+        return max(1, round(min(width, height) * self.font_scale)) if self.font_scale else self.font_size
+
+    def for_image(self, width, height, text=None, luminance=None):
+        """
+        按图片尺寸换算相对字号，按亮度统计选择自动位置，返回具体的渲染计划（按设置缓存）。
+        luminance 为缩小的灰度图或返回它的函数，只在需要自动位置时调用；为 None 时自动位置落在右下角。
+        """
+        if not self.adaptive:
+            return self
+        settings = dict(zip(_PLAN_KEYS + tuple(_PLAN_DEFAULTS), self.key))
+        settings["font_size"] = font_size = self.font_size_for(width, height)
+        if AUTO_POSITION in (self.pos_x, self.pos_y):
+            luminance = luminance() if callable(luminance) else luminance
+            ink = text_layout(self.text if text is None else text, self.font_path, font_size).ink
+            if luminance is not None:
+                settings["pos_x"], settings["pos_y"] = least_busy_position(luminance, width, height, ink, self.color, self.pos_x, self.pos_y)
+            else:
+                settings["pos_x"], settings["pos_y"] = (-2 if p == AUTO_POSITION else p for p in (self.pos_x, self.pos_y))
+        return compile_render_plan(settings, self.output_format)
+
+    def layout(self, text=None):
+        return text_layout(self.text if text is None else text, self.font_path, self.font_size)
+
+    def position(self, width, height, text=None):
+        return resolve_position(self.pos_x, self.pos_y, width, height, self.layout(text).ink)
+
+    def stamp(self, img, x, y, text):
+        """在图片的 (x, y) 处合成水印图章（位置已换算好）。"""
+        return stamp_watermark(img, x, y, text, self.font_path, self.font_size, self.color, self.alpha,
+                               self.style, self.outline_color, self.blend_mode)
+
+    def apply(self, img, text):
+        """在已解码的图片上原地绘制水印。"""
+        if self.adaptive:
+            return self.for_image(img.width, img.height, text, lambda: luminance_proxy(img)).apply(img, text)
+        return watermark_image(img, text, self.font_path, self.font_size, self.color, self.alpha,
+                               self.pos_x, self.pos_y, self.style, self.outline_color, self.blend_mode)
+
+    def render(self, img_src, text=None):
+        """为路径/字节串中的图片添加水印，返回 (图片, EXIF)；文本为空时返回 None。"""
+        if not isinstance(img_src, (str, os.PathLike, bytes, bytearray, memoryview)):
+            img_src = img_src.read()  # 类文件对象只能读取一次
+        text = self.resolve_text(img_src) if text is None else text
+        if not text: return None
+        if self.adaptive:
+            img, exif_data, label, is_png = _decode_source(img_src)
+            return _finish_output(self.apply(img, text), exif_data, label, is_png)
+        # add_watermark 现在返回图片和EXIF
+        return add_watermark(img_src, text, self.font_path, self.font_size, self.color, self.alpha,
+                             self.pos_x, self.pos_y, self.style, self.outline_color, self.blend_mode)
+
+    def save(self, img, exif_bytes, out):
+        save_watermarked(img, exif_bytes, out, self.output_format, self.encoder)
+
+    def with_format(self, output_format):
+        return _compile_render_plan(self.key, output_format.lower())
+
+    def scaled(self, scale):
+        """缩小后的版本按比例缩放字号和绝对坐标，使水印在各版本中的相对位置和大小一致。"""
+        if scale == 1:
+            return self
+        settings = dict(zip(_PLAN_KEYS + tuple(_PLAN_DEFAULTS), self.key))
+        if not self.font_scale:  # 相对字号本身与尺寸无关
+            settings["font_size"] = max(1, round(self.font_size * scale))
+        for key in ("pos_x", "pos_y"):
+            if _is_number(settings[key]) and settings[key] >= 0: settings[key] = settings[key] * scale
+        return compile_render_plan(settings, self.output_format)
+
+def _parse_rgb(value, label):
+    try:
+        rgb = parse_color(value)
+    except (AttributeError, ValueError):
+        raise ValueError(f"{label}格式不正确: {value!r}，应为 \"R,G,B\"")
+    if len(rgb) != 3 or not all(0 <= c <= 255 for c in rgb):
+        raise ValueError(f"{label}格式不正确: {value!r}，应为 0-255 的三个整数")
+    return rgb
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+@functools.lru_cache(maxsize=1024)
+def _compile_render_plan(key, output_format):
+    text, font_name, font_size, text_color, outline_color, alpha, style, pos_x, pos_y, blend_mode = key
+    if not isinstance(text, str): raise ValueError(f"水印文本必须是字符串: {text!r}")
+    if not isinstance(font_name, str) or not font_name: raise ValueError(f"字体名称无效: {font_name!r}")
+    font_scale = 0.0
+    if isinstance(font_size, str) and font_size.strip().endswith("%"):
+        try: font_scale = float(font_size.strip()[:-1]) / 100
+        except ValueError: font_scale = -1
+        if not 0 < font_scale <= 1: raise ValueError(f"相对字号必须在 0%-100% 之间: {font_size!r}")
+    elif not _is_number(font_size) or int(font_size) != font_size or font_size <= 0:
+        raise ValueError(f"字号必须是正整数或短边的百分比（如 \"5%\"）: {font_size!r}")
+    color = _parse_rgb(text_color, "文本颜色")
+    outline = _parse_rgb(outline_color, "描边颜色")
+    if not _is_number(alpha) or not 0 <= alpha <= 100: raise ValueError(f"透明度必须在 0-100 之间: {alpha!r}")
+    if style not in WATERMARK_STYLES: raise ValueError(f"未知的样式: {style!r}")
+    if blend_mode not in BLEND_MODES: raise ValueError(f"未知的混合模式: {blend_mode!r}")
+    for pos in (pos_x, pos_y):
+        if not _is_number(pos) and pos != AUTO_POSITION: raise ValueError(f"位置必须是数字或 \"auto\": {pos_x!r}, {pos_y!r}")
+    if output_format not in OUTPUT_FORMATS: raise ValueError(f"不支持的输出格式: {output_format!r}")
+
+    font_size = None if font_scale else int(font_size)
+    font_path = get_font_path(font_name)
+    if font_size: load_font(font_path, font_size)  # 预热字体缓存，图章和排版都从缓存取字体对象
+    return RenderPlan(text, font_name, font_path, font_size, font_scale, color, outline, alpha, style, pos_x, pos_y, blend_mode, output_format,
+                      encoder=encoder_for(output_format), key=key)
+
+def compile_render_plan(settings, output_format="jpg"):
+    """把设置字典编译为 RenderPlan，设置无效时抛出 ValueError。"""
+    if isinstance(settings, RenderPlan):
+        return settings if settings.output_format == output_format.lower() else settings.with_format(output_format)
+    try:
+        key = tuple(settings[k] for k in _PLAN_KEYS) + tuple(settings.get(k, v) for k, v in _PLAN_DEFAULTS.items())
+        hash(key)
+    except KeyError as e:
+        raise ValueError(f"设置缺少字段: {e.args[0]}")
+    except TypeError:
+        raise ValueError("设置中包含无法识别的值")
+    return _compile_render_plan(key, str(output_format).lower())
+
+def watermark_with_settings(img_src, settings):
+    """
+    按设置字典（或 RenderPlan）为图片添加水印，返回 (图片, EXIF)；水印文本为空时返回 None。
+    """
+    return compile_render_plan(settings).render(img_src)
+
+def watermark_bytes(img_src, settings, output_format="jpg"):
+    """
+    内存接口：输入编码后的图片字节串或类文件对象，返回 (编码后的输出字节串, EXIF字节串)。
+    settings 可以是设置字典或 RenderPlan。水印文本为空或设置无效时抛出 ValueError。
+    """
+    plan = compile_render_plan(settings, output_format)
+    result = plan.render(img_src)
+    if result is None: raise ValueError("水印文本为空")
+    watermarked_img, exif_bytes = result
+    buffer = io.BytesIO()
+    plan.save(watermarked_img, exif_bytes, buffer)
+    return buffer.getvalue(), exif_bytes
+
+# --- 超大图片模式：内存占用受 MEMORY_BUDGET_MB 限制 ---
+MEMORY_BUDGET_MB = float(os.environ.get("WATERMARK_MEMORY_BUDGET_MB", 1024))
+# 常规路径的峰值：解码原图 + RGBA 副本 + 输出时的 RGB 副本，约 11 字节/像素
+_STANDARD_BYTES_PER_PIXEL = 11
+_RAW_BYTES_PER_PIXEL = {"L": 1, "LA": 2, "RGB": 3, "RGBA": 4, "RGBX": 4, "CMYK": 4}
+
+class MemoryBudgetError(MemoryError):
+    """单个文件即使走大图模式也放不进内存预算时抛出，文件不会被处理。"""
+
+def _open_unchecked(img_path):
+    """
+    打开图片但跳过 Pillow 的解压炸弹检查；超大图片的内存由预算控制。
+    直接调用格式插件，不修改全局的 Image.MAX_IMAGE_PIXELS，其它线程中的 Image.open 仍照常检查。
+    """
+    Image.init()
+    fp = open(img_path, "rb")
+    try:
+        prefix = fp.read(16)
+        for fmt in Image.ID:
+            factory, accept = Image.OPEN[fmt]
+            result = accept(prefix) if accept else True
+            if not result or isinstance(result, str):  # 字符串表示插件识别出格式但不支持
+                continue
+            fp.seek(0)
+            try:
+                img = factory(fp, img_path)
+            except (SyntaxError, IndexError, TypeError, struct.error):
+                continue
+            img._exclusive_fp = True  # 与 Image.open 一致：关闭图片时一并关闭文件
+            return img
+    except BaseException:
+        fp.close()
+        raise
+    fp.close()
+    raise Image.UnidentifiedImageError(f"cannot identify image file {img_path!r}")
+
+def needs_large_mode(width, height, budget_mb=None):
+    budget = (budget_mb or MEMORY_BUDGET_MB) * 1024 * 1024
+    pixels = width * height
+    return pixels * _STANDARD_BYTES_PER_PIXEL > budget or (Image.MAX_IMAGE_PIXELS and pixels > Image.MAX_IMAGE_PIXELS)
+
+def _raw_strips(img):
+    """
+    图片由整行宽度的未压缩条带组成时（未压缩 TIFF、PPM 等），
+    返回 [(起始行, 结束行, 文件偏移, rawmode, 行跨度)]，否则返回 None。
+    """
+    strips = []
+    for codec, extents, offset, args in img.tile:
+        args = (args,) if isinstance(args, str) else tuple(args)
+        rawmode = args[0]
+        stride = args[1] if len(args) > 1 else 0
+        orientation = args[2] if len(args) > 2 else 1
+        x0, y0, x1, y1 = extents
+        if codec != "raw" or rawmode not in _RAW_BYTES_PER_PIXEL or orientation != 1 or (x0, x1) != (0, img.width):
+            return None
+        strips.append((y0, y1, offset, rawmode, stride or img.width * _RAW_BYTES_PER_PIXEL[rawmode]))
+    return sorted(strips) or None
+
+def _iter_raw_bands(img_path, img, strips, max_rows):
+    """逐段读取未压缩条带，每次只在内存中保留 max_rows 行。"""
+    with open(img_path, "rb") as f:
+        for y0, y1, offset, rawmode, stride in strips:
+            for top in range(y0, y1, max_rows):
+                rows = min(max_rows, y1 - top)
+                f.seek(offset + (top - y0) * stride)
+                data = f.read(rows * stride)
+                yield top, Image.frombuffer(img.mode, (img.width, rows), data, "raw", rawmode, stride, 1)
+
+class _PngStreamWriter:
+    """逐段写出 PNG：每行使用 Up 滤波，IDAT 随写随压缩，不需要整幅图片在内存中。"""
+    def __init__(self, f, width, height, mode):
+        import zlib
+        self.f = f
+        self.channels = {"RGB": 3, "RGBA": 4}[mode]
+        self._compressor = zlib.compressobj(6)
+        self._previous_row = np.zeros(width * self.channels, dtype=np.uint8)
+        f.write(b"\x89PNG\r\n\x1a\n")
+        self._chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2 if self.channels == 3 else 6, 0, 0, 0))
+
+    def _chunk(self, chunk_type, data):
+        import zlib
+        self.f.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.f.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    def write_band(self, band):
+        rows = np.asarray(band, dtype=np.uint8).reshape(band.height, -1)
+        previous = np.vstack([self._previous_row[None, :], rows[:-1]])
+        filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+        filtered[:, 0] = 2  # Up 滤波
+        np.subtract(rows, previous, out=filtered[:, 1:])
+        data = self._compressor.compress(filtered.tobytes())
+        if data: self._chunk(b"IDAT", data)
+        self._previous_row = rows[-1].copy()
+
+    def close(self):
+        self._chunk(b"IDAT", self._compressor.flush())
+        self._chunk(b"IEND", b"")
+
+def render_large_file(img_path, out_path, plan, text, budget_mb=None):
+    """
+    超大图片的水印处理，结果与 add_watermark + save_watermarked 一致。
+    - 未压缩条带的源图输出 PNG 时按条带流式读取、只给水印经过的条带合成、边压缩边写出，
+      峰值内存不超过预算，与图片尺寸无关。
+    - 其它情况按原始模式（RGB 3 字节/像素）解码，只在水印区域合成，
+      不再分配整幅 RGBA 图层和副本；JPEG 等格式只能整幅解码，峰值约为解码后图片的大小。
+    - 剩余的限制：解码后的图片本身超出预算时无法处理，抛出 MemoryBudgetError，
+      需要提高预算或先转换为未压缩 TIFF 并输出 PNG。
+    """
+    budget = (budget_mb or MEMORY_BUDGET_MB) * 1024 * 1024
+    is_png = img_path.lower().endswith(".png")
+    exif_bytes = read_exif_segment(img_path) if img_path.lower().endswith((".jpg", ".jpeg")) else None
+
+    with _open_unchecked(img_path) as img:
+        width, height = img.size
+        # 自动位置只用 JPEG 的 1/8 DCT 亮度统计；其它格式无法低成本缩小解码，落在右下角
+        plan = plan.for_image(width, height, text, lambda: jpeg_luminance_proxy(img_path))
+        x, y = plan.position(width, height, text)
+        strips = _raw_strips(img) if plan.output_format == "png" and not is_png else None
+        if strips:
+            # 条带 + RGB 副本 + 滤波缓冲，每行约 3 份行数据
+            max_rows = max(1, int(budget // (width * 4 * 3)))
+            with _atomic_output(out_path) as target, open(target, "wb") as f:
+                writer = _PngStreamWriter(f, width, height, "RGB")
+                for top, band in _iter_raw_bands(img_path, img, strips, max_rows):
+                    band = band.convert("RGB")
+                    plan.stamp(band, x, y - top, text)
+                    writer.write_band(band)
+                writer.close()
+            return out_path
+
+        native_bytes = width * height * (4 if is_png else 3)
+        if native_bytes > budget:
+            raise MemoryBudgetError(f"{os.path.basename(img_path)} 需约 {native_bytes / 1024 / 1024:.0f} MB，"
+                                    f"超出内存预算 {budget / 1024 / 1024:.0f} MB；只有未压缩条带的 TIFF/PPM 输出 PNG 时可以分段处理")
+        img.load()
+        base = img if img.mode == ("RGBA" if is_png else "RGB") else img.convert("RGBA" if is_png else "RGB")
+    plan.stamp(base, x, y, text)
+    plan.save(base, exif_bytes, out_path)
+    return out_path
+
+def estimate_memory(fpath, plan, budget_mb=None, renditions=None):
+    """
+    只读取文件头估算处理单个文件的峰值内存（字节），与 render_file 选择的处理路径一致：
+    常规路径按 _STANDARD_BYTES_PER_PIXEL 计，分段写出占满预算，其它大图为解码后的图片大小，
+    多帧图片为单帧 RGBA 加调色板帧（_multiframe_bytes）。传入 renditions 时按 render_renditions 的整幅解码估算。结果超出预算的文件会被拒绝处理。
+    """
+    budget = (budget_mb or MEMORY_BUDGET_MB) * 1024 * 1024
+    try:
+        with _open_unchecked(fpath) as img:
+            width, height = img.size
+            animated = getattr(img, "is_animated", False)
+            large = needs_large_mode(width, height, budget_mb) and not animated
+            is_png = fpath.lower().endswith(".png")
+            streamed = large and not renditions and plan.output_format == "png" and not is_png and _raw_strips(img)
+    except (OSError, ValueError):
+        return 0
+    if animated:
+        return _multiframe_bytes(width, height)
+    if not large:
+        return width * height * _STANDARD_BYTES_PER_PIXEL
+    if renditions:
+        return _renditions_bytes(width, height, is_png, len(renditions))
+    return budget if streamed else width * height * (4 if is_png else 3)
+
+class MemoryGate:
+    """
+    多个任务共享的内存预算：reserve 在已占用量加上本次需求超出预算时等待其它任务释放。
+    没有任务占用时总能通过，单独超出预算的文件由 render_large_file 自行拒绝。
+    """
+    def __init__(self, budget_mb=None):
+        self.budget = (budget_mb or MEMORY_BUDGET_MB) * 1024 * 1024
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def fits(self, nbytes):
+        return self.used == 0 or self.used + nbytes <= self.budget
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        with self._cond:
+            self._cond.wait_for(lambda: self.fits(nbytes))
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+# --- 多帧图片：动图 GIF/WebP、多页 TIFF 的每一帧都加水印 ---
+MULTIFRAME_FORMATS = {"GIF": "gif", "WEBP": "webp", "TIFF": "tiff"}
+
+def multiframe_format(img_path):
+    """多帧图片返回其容器格式的扩展名（gif/webp/tiff），单帧图片返回 None。只读取文件头。"""
+    try:
+        with _open_unchecked(img_path) as img:
+            if img.format in MULTIFRAME_FORMATS and getattr(img, "is_animated", False):
+                return MULTIFRAME_FORMATS[img.format]
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _multiframe_bytes(width, height):
+    """多帧图片逐帧处理时的峰值内存：当前帧的 RGBA 副本（4 字节/像素）加量化后的调色板帧（1 字节/像素）。"""
+    return width * height * 5
+
+def check_multiframe_limits(img_path, width, height, budget_mb=None):
+    """
+    多帧图片没有分段处理的路径，解码前检查：像素数超过 Image.MAX_IMAGE_PIXELS 时抛出
+    DecompressionBombError，单帧所需内存超出预算时抛出 MemoryBudgetError。
+    """
+    fname = os.path.basename(img_path)
+    if Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(f"{fname} 每帧 {width * height} 像素，超过上限 {Image.MAX_IMAGE_PIXELS}，多帧图片无法分段处理")
+    budget = (budget_mb or MEMORY_BUDGET_MB) * 1024 * 1024
+    needed = _multiframe_bytes(width, height)
+    if needed > budget:
+        raise MemoryBudgetError(f"{fname} 每帧需约 {needed / 1024 / 1024:.0f} MB，超出内存预算 {budget / 1024 / 1024:.0f} MB")
+
+class _StampedFrames(Image.Image):
+    """
+    把源图的各帧包装成一张"多帧图片"交给 Pillow 的 save_all：写入器每 seek 一帧才解码、
+    缩放并盖上水印，内存中只保留当前帧。各帧位置相同时 render_stamp 的缓存保证图章只栅格化一次。
+    GIF 帧合成后重新转为调色板图片（见 _to_palette），透明像素映射到透明色索引。
+    """
+    def __init__(self, source, plan, text, size=None):
+        super().__init__()
+        self._source, self._plan, self._text, self._target = source, plan, text, size
+        self.n_frames = source.n_frames
+        self.is_animated = True
+        self._frame = -1
+        self._plans = {}  # 帧尺寸 -> 具体的渲染计划；自动位置由该尺寸的第一帧决定，动画中不会跳动
+        source.seek(0)
+        self._is_gif = source.format == "GIF"
+        self._global = None  # 首帧（全局）调色板：(颜色键, 索引, 调色板, 透明色索引)
+        if self._is_gif and source.mode == "P":
+            palette = source.getpalette()
+            transparency = source.info.get("transparency")
+            lut = {}
+            for i in range(len(palette) // 3):
+                if i != transparency: lut.setdefault(_color_key(palette[i * 3:i * 3 + 3]), i)
+            keys = np.array(sorted(lut), dtype=np.uint32)
+            self._global = (keys, np.array([lut[k] for k in keys], dtype=np.uint8), palette, transparency)
+        self.seek(0)
+
+    def tell(self): return self._frame
+
+    def seek(self, frame):
+        if frame == self._frame: return
+        if not 0 <= frame < self.n_frames: raise EOFError("no more images")
+        self._source.seek(frame)
+        source = self._source
+        has_alpha = source.has_transparency_data
+        img = source.convert("RGBA" if has_alpha else "RGB")
+        if self._target and img.size != self._target: img = _downscale(img, self._target)
+        plan = self._plans.get(img.size)
+        if plan is None:
+            plan = self._plans[img.size] = self._plan.for_image(img.width, img.height, self._text, lambda: luminance_proxy(img))
+        x, y = plan.position(img.width, img.height, self._text)
+        plan.stamp(img, x, y, self._text)
+        info = dict(source.info)
+        if self._is_gif:
+            img, transparency = self._to_palette(img)
+            info.pop("transparency", None)
+            if transparency is not None: info["transparency"] = transparency
+        self.im, self._mode, self._size, self.palette = img.im, img.mode, img.size, img.palette
+        self.info, self._frame = info, frame
+
+    def _to_palette(self, img):
+        """
+        把盖好水印的帧转回调色板图片，返回 (图片, 透明色索引或 None)：
+        - 帧中所有颜色（含水印）都在首帧的全局调色板中时沿用它，不改变任何像素；
+        - 否则（帧带自己的局部调色板，或水印颜色不在全局调色板中）颜色不超过 256 种时用精确的局部调色板，
+          更多时按该帧自适应量化；需要透明时额外保留一个不与任何颜色重复的透明色索引。
+        """
+        rgb = np.asarray(img.convert("RGB"), dtype=np.uint32)
+        keys = (rgb[..., 0] << 16) | (rgb[..., 1] << 8) | rgb[..., 2]
+        clear = np.asarray(img.getchannel("A")) < 128 if img.mode == "RGBA" else np.zeros(keys.shape, dtype=bool)
+        has_clear = bool(clear.any())
+        opaque = keys[~clear]
+        if self._global is not None and (not has_clear or self._global[3] is not None) and np.isin(opaque, self._global[0]).all():
+            lut_keys, lut_index, palette, transparency = self._global
+            indices = lut_index[np.minimum(np.searchsorted(lut_keys, keys), len(lut_keys) - 1)]
+        else:
+            slots = 256 - has_clear
+            unique = np.unique(opaque)
+            if len(unique) <= slots:
+                indices = np.minimum(np.searchsorted(unique, keys), max(len(unique) - 1, 0)).astype(np.uint8)
+                palette = [channel for k in unique.tolist() for channel in (k >> 16, (k >> 8) & 255, k & 255)]
+            else:
+                quantized = img.convert("RGB").quantize(slots, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+                indices, palette = np.asarray(quantized), quantized.getpalette()[:slots * 3]
+            transparency = None
+            if has_clear:
+                used = {_color_key(palette[i:i + 3]) for i in range(0, len(palette), 3)}
+                spare = next(k for k in range(1 << 24) if k not in used)
+                transparency = len(palette) // 3
+                palette = palette + [spare >> 16, (spare >> 8) & 255, spare & 255]
+        if has_clear: indices = np.where(clear, transparency, indices)
+        out = Image.fromarray(indices.astype(np.uint8), "P")
+        out.putpalette(palette)
+        return out, transparency if has_clear else None
+
+def _color_key(rgb):
+    return (int(rgb[0]) << 16) | (int(rgb[1]) << 8) | int(rgb[2])
+
+def render_multiframe(img_path, out_path, plan, text, size=None, budget_mb=None):
+    """
+    为多帧图片的每一帧加水印，按源图的容器格式输出，保留帧时长、循环次数和调色板。
+    size 不为 None 时各帧先缩小到该尺寸。帧按需逐个解码、编码，峰值内存约为单帧大小
+    （GIF 写入器为做帧间差分会保留已量化的调色板帧，每像素 1 字节）。
+    解码前按 check_multiframe_limits 检查像素数和内存预算，超出时不处理。
+    """
+    with _open_unchecked(img_path) as source:
+        check_multiframe_limits(img_path, source.width, source.height, budget_mb)
+        fmt = MULTIFRAME_FORMATS[source.format]
+        options = {"save_all": True}
+        if fmt == "gif":
+            options["optimize"] = False  # 不重排调色板
+        elif fmt == "webp":
+            # WebP 写入器只在开始时读取一次时长，各帧时长不同时需预先给出列表（只解码，不保留帧）
+            durations = []
+            for i in range(source.n_frames):
+                source.seek(i); source.load()
+                durations.append(source.info.get("duration", 0))
+            with open(img_path, "rb") as f:
+                lossless = b"VP8L" in f.read(65536)  # 首帧为无损编码时输出也用无损，避免重复有损压缩
+            options.update(duration=durations, loop=source.info.get("loop", 0), lossless=lossless, quality=90)
+            if isinstance(source.info.get("background"), tuple): options["background"] = source.info["background"]
+            if source.info.get("exif"): options["exif"] = source.info["exif"]
+        frames = _StampedFrames(source, plan, text, size)
+        with _atomic_output(out_path) as target:
+            frames.save(target, format=fmt.upper(), **options)
+    return out_path
+
+def render_file(fpath, plan, output_dir, naming_rule, custom_text, budget_mb=None, cache=None):
+    """
+    按渲染计划为单个文件添加水印并保存到输出文件夹，输出格式由计划决定。
+    超出内存预算的大图自动走 render_large_file；多帧图片按源图格式输出（render_multiframe）；
+    传入 OutputCache 时先查缓存。返回输出路径；水印文本为空时返回 None。
+    """
+    fname = os.path.basename(fpath)
+    frames_format = multiframe_format(fpath)
+    out_path = os.path.join(output_dir, build_output_name(fname, frames_format or plan.output_format, naming_rule, custom_text))
+    final_text = plan.resolve_text(fpath)
+    if not final_text: print(f"{fname} 水印文本为空，跳过"); return None
+    cache_key = cache.key_for(fpath, plan, frames_format) if cache else None
+    if cache and cache.fetch(cache_key, out_path):
+        return out_path
+
+    with _open_unchecked(fpath) as probe:
+        width, height = probe.size
+    if frames_format:
+        render_multiframe(fpath, out_path, plan, final_text, budget_mb=budget_mb)
+    elif needs_large_mode(width, height, budget_mb):
+        render_large_file(fpath, out_path, plan, final_text, budget_mb)
+    else:
+        watermarked_img, exif_bytes = plan.render(fpath, final_text)
+        plan.save(watermarked_img, exif_bytes, out_path)
+    if cache: cache.store(cache_key, out_path)
+    return out_path
+
+# --- 输出缓存：相同源文件 + 相同设置的结果直接链接/复制，不再重新渲染 ---
+_FICLONE = 0x40049409  # Linux ioctl：在支持的文件系统（btrfs、xfs 等）上创建写时复制副本
+
+def _clone_file(src, dst):
+    """
+    先尝试 reflink，不支持时复制，把 src 原子地放到 dst。返回实际使用的方式。
+    不使用硬链接：共用 inode 时任何一方被原地改写（用户编辑、旧版本程序覆盖）都会连带改动另一方。
+    """
+    tmp = f"{dst}.{os.getpid()}.{threading.get_ident()}.tmp"
+    if sys.platform.startswith("linux"):
+        try:
+            import fcntl
+            with open(src, "rb") as s, open(tmp, "wb") as d:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            os.replace(tmp, dst)
+            return "reflink"
+        except OSError:
+            if os.path.exists(tmp): os.remove(tmp)
+    try:
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    return "copy"
+
+_FILE_DIGESTS = {}  # path -> ((mtime_ns, size), sha256)
+_FILE_DIGESTS_LOCK = threading.Lock()
+
+def file_digest(path):
+    """源文件内容的 SHA-256，按路径和修改时间缓存。"""
+    st = os.stat(path)
+    signature = (st.st_mtime_ns, st.st_size)
+    with _FILE_DIGESTS_LOCK:
+        cached = _FILE_DIGESTS.get(path)
+    if cached and cached[0] == signature:
+        return cached[1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    with _FILE_DIGESTS_LOCK:
+        _FILE_DIGESTS[path] = (signature, digest.hexdigest())
+    return digest.hexdigest()
+
+class OutputCache:
+    """
+    内容寻址的输出缓存。键由源文件内容哈希、渲染计划（含字体文件和输出格式）以及 Pillow 版本组成，
+    与文件名和输出文件夹无关，所以同一批原图重新交付到新文件夹时可以直接复用。
+    存入和命中时都用 reflink（不支持时复制）生成独立的文件，条目不会与任何输出共用 inode；
+    总大小超过上限时按访问时间（atime，命中时显式设置，不改动 mtime）淘汰最久未使用的条目。
+    多个线程/进程可以共用同一个缓存目录，所有写入都先写临时文件再重命名。
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.total_bytes = sum(size for _, _, size in self._entries())
+
+    def _entries(self):
+        for shard in os.scandir(self.cache_dir):
+            if not shard.is_dir(): continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".tmp"): continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, st.st_atime, st.st_size
+
+    def key_for(self, src_path, plan, extra=None):
+        import PIL
+        settings = repr((plan.key, plan.output_format, plan.font_path, extra, PIL.__version__))
+        return hashlib.sha256((file_digest(src_path) + settings).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def fetch(self, key, out_path):
+        """命中时生成 out_path 并返回 True。"""
+        entry = self._entry_path(key)
+        try:
+            _clone_file(entry, out_path)
+            # 只更新访问时间作为 LRU 依据（挂载了 noatime 也能显式设置），修改时间保持不变
+            os.utime(entry, ns=(time.time_ns(), os.stat(entry).st_mtime_ns))
+        except FileNotFoundError:
+            with self._lock: self.misses += 1
+            return False
+        with self._lock: self.hits += 1
+        return True
+
+    def store(self, key, out_path):
+        entry = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        try:
+            _clone_file(out_path, entry)
+        except OSError as e:
+            print(f"警告：无法写入输出缓存: {e}")
+            return
+        with self._lock:
+            self.total_bytes += os.path.getsize(entry)
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def evict(self):
+        """按最近访问时间从旧到新删除条目，直到总大小低于上限的 90%。"""
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        target = self.max_bytes * 0.9
+        for path, _, size in entries:
+            if total <= target: break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                continue
+        with self._lock:
+            self.total_bytes = total
+
+_OUTPUT_CACHE = None
+
+def get_output_cache():
+    """根据 WATERMARK_CACHE_DIR / WATERMARK_CACHE_MB 返回共享的输出缓存，未配置时返回 None。"""
+    global _OUTPUT_CACHE
+    cache_dir = os.environ.get("WATERMARK_CACHE_DIR")
+    if not cache_dir:
+        return None
+    if _OUTPUT_CACHE is None or _OUTPUT_CACHE.cache_dir != cache_dir:
+        _OUTPUT_CACHE = OutputCache(cache_dir, int(float(os.environ.get("WATERMARK_CACHE_MB", 2048)) * 1024 * 1024))
+    return _OUTPUT_CACHE
+
+# --- 多版本输出：一次解码，按 renditions 列表输出多个不同尺寸/模板/格式的版本 ---
+def resolve_renditions(renditions, templates, output_format="jpg"):
+    """
+    把 renditions 配置解析为可直接渲染的列表。每项可包含：
+    template（模板名，省略时使用图片自身的设置）、max_size（长边像素，省略为原尺寸）、
+    format（jpg/png，省略时与本次任务的输出格式 output_format 相同）、
+    naming（保持原名/添加前缀/添加后缀）、affix（前缀或后缀文本）。
+    指定了模板的项会预先编译为渲染计划，模板设置无效时抛出 ValueError。
+    """
+    resolved = []
+    for rendition in renditions:
+        rendition = dict(rendition)
+        name = rendition.get("template")
+        if name:
+            if name not in templates: raise ValueError(f"未找到模板 '{name}'")
+            try: rendition["plan"] = compile_render_plan(templates[name], rendition.get("format", output_format))
+            except ValueError as e: raise ValueError(f"模板 '{name}' 设置无效: {e}")
+        resolved.append(rendition)
+    return resolved
+
+def _renditions_bytes(width, height, is_png, versions):
+    """大图多版本输出的峰值内存：解码后的图片，有多个版本时另加一份用于后续缩小的副本。"""
+    return width * height * (4 if is_png else 3) * (2 if versions > 1 else 1)
+
+def _downscale(img, size):
+    """缩小到 size：先用 reduce() 做整数倍的快速盒式缩小，剩余部分再用 LANCZOS 精确缩放。"""
+    factor = min(img.width // size[0], img.height // size[1])
+    if factor >= 2:
+        img = img.reduce(factor)
+    if img.size != size:
+        img = img.resize(size, Image.LANCZOS)
+    return img
+
+def render_renditions(fpath, plan, renditions, output_dir, naming_rule, custom_text, cache=None):
+    """
+    只解码一次源图，按从大到小的顺序输出各版本：每个版本从上一个（更大的）版本缩小得到，
+    再盖上各自模板的水印并编码。所有版本都命中输出缓存时不解码源图。返回输出路径列表。
+    多帧图片的各版本按源图格式输出，每个版本各自流式处理一遍所有帧。
+    源图按原始模式解码（不透明的图片为 RGB）；超出常规内存预算的大图跳过解压炸弹检查，
+    解码后的图片（有多个版本时另加一份副本）超出预算时抛出 MemoryBudgetError。
+    """
+    fname = os.path.basename(fpath)
+    frames_format = multiframe_format(fpath)
+    with _open_unchecked(fpath) as img_file:
+        width, height = img_file.size  # 只读取文件头
+    large = needs_large_mode(width, height)
+    long_edge = max(width, height)
+    def target_scale(rendition):
+        return min(1, (rendition.get("max_size") or long_edge) / long_edge)
+
+    out_paths, jobs = [], []
+    for rendition in sorted(renditions, key=target_scale, reverse=True):
+        scale = target_scale(rendition)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        rendition_plan = (rendition.get("plan") or plan.with_format(rendition.get("format", plan.output_format))).scaled(scale)
+        final_text = rendition_plan.resolve_text(fpath)
+        if not final_text: print(f"{fname} 水印文本为空，跳过该版本"); continue
+        out_name = build_output_name(fname, frames_format or rendition_plan.output_format, rendition.get("naming", naming_rule), rendition.get("affix", custom_text))
+        out_path = os.path.join(output_dir, out_name)
+        cache_key = cache.key_for(fpath, rendition_plan, (size, frames_format) if frames_format else size) if cache else None
+        if cache and cache.fetch(cache_key, out_path):
+            out_paths.append(out_path)
+            continue
+        jobs.append((size, rendition_plan, final_text, out_path, cache_key))
+    if not jobs:
+        return out_paths
+    if frames_format:
+        for size, rendition_plan, final_text, out_path, cache_key in jobs:
+            render_multiframe(fpath, out_path, rendition_plan, final_text, size)
+            if cache: cache.store(cache_key, out_path)
+            out_paths.append(out_path)
+        return out_paths
+
+    source_exif = None
+    is_png = fpath.lower().endswith(".png")
+    if fpath.lower().endswith((".jpg", ".jpeg")):
+        try: source_exif = piexif.dump(piexif.load(fpath))
+        except Exception as e: print(f"警告：无法加载 {fname} 的EXIF信息: {e}")
+    if large:
+        needed = _renditions_bytes(width, height, is_png, len(jobs))
+        budget = MEMORY_BUDGET_MB * 1024 * 1024
+        if needed > budget:
+            raise MemoryBudgetError(f"{fname} 需约 {needed / 1024 / 1024:.0f} MB，超出内存预算 {budget / 1024 / 1024:.0f} MB")
+    with (_open_unchecked if large else Image.open)(fpath) as img_file:
+        # 与 _decode_source 一致：只有需要透明通道时才转为 RGBA
+        has_alpha = img_file.mode in ("RGBA", "LA", "PA", "RGBa", "La") or "transparency" in img_file.info
+        working_mode = "RGBA" if is_png or has_alpha else "RGB"
+        base = img_file.convert(working_mode) if img_file.mode != working_mode else img_file
+        base.load()
+
+    for i, (size, rendition_plan, final_text, out_path, cache_key) in enumerate(jobs):
+        if base.size != size:
+            base = _downscale(base, size)
+        # 后面的版本还要从 base 缩小，最后一个版本可以直接在 base 上绘制
+        img = base if i == len(jobs) - 1 else base.copy()
+        rendition_plan.apply(img, final_text)
+        # 与 add_watermark 一致：PNG 源图保留透明通道，其余转为 RGB 并带上 EXIF
+        rendition_plan.save(img if is_png or img.mode == "RGB" else img.convert("RGB"), None if is_png else source_exif, out_path)
+        if cache: cache.store(cache_key, out_path)
+        out_paths.append(out_path)
+    return out_paths
+
+# --- 模板存储：每个模板一个 JSON 文件加一个索引，原子写入、保留历史版本、按需加载 ---
+TEMPLATE_HISTORY_LIMIT = 20  # 每个模板保留的历史版本数
+_SESSION_PREFIX = "__"        # "__last_session__" 这类内部条目不保留历史
+
+def _atomic_write_json(path, data):
+    """先写临时文件并 fsync，再用 os.replace 替换，写到一半崩溃也不会留下损坏的文件。"""
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp): os.remove(tmp)
+        raise
+    if os.name == "posix":  # 目录项也落盘，重命名在断电后才可靠
+        try:
+            fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+            try: os.fsync(fd)
+            finally: os.close(fd)
+        except OSError:
+            pass
+
+@contextlib.contextmanager
+def _file_lock(path):
+    """跨进程的排它锁（POSIX 用 fcntl.flock，Windows 用 msvcrt.locking），进程退出时自动释放。"""
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try: msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1); break
+                except OSError: continue  # LK_LOCK 最多重试 10 秒，超时后继续等待
+            try: yield
+            finally: f.seek(0); msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try: yield
+            finally: fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+class TemplateStore(MutableMapping):
+    """
+    模板和会话设置的存储，用法与字典相同（store[name] = settings、del store[name]、in、遍历）。
+    目录结构：index.json 记录模板名、文件名和版本号；每个模板单独一个 <id>.json；
+    被覆盖或删除的版本移到 history/<id>/<版本>.json，最多保留 TEMPLATE_HISTORY_LIMIT 个。
+    - 启动时只读索引，模板内容在第一次访问时才读取，之后按版本号缓存；
+    - 保存/删除只写该模板的文件和索引，所有写入都是临时文件 + fsync + os.replace；
+    - 写操作在进程内用 RLock、进程间用 .lock 文件串行化，读取不加锁（文件总是完整的）；
+      其它进程（图形界面、批处理工作进程、监视模式）的修改通过索引文件的变化自动发现。
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(os.path.join(self.directory, "history"), exist_ok=True)
+        self._index_path = os.path.join(self.directory, "index.json")
+        self._lock = threading.RLock()
+        self._index = {}
+        self._index_signature = None
+        self._cache = {}  # name -> (version, settings)
+        self._write_depth = 0
+        self._refresh_index()
+
+    def __reduce__(self):
+        # 传给工作进程时只传目录，由工作进程自己按需读取
+        return (TemplateStore, (self.directory,))
+
+    @staticmethod
+    def _file_id(name):
+        return hashlib.sha1(name.encode("utf-8")).hexdigest()[:16]
+
+    def _refresh_index(self):
+        """索引文件变化（本进程或其它进程写入）时重新读取。"""
+        try:
+            st = os.stat(self._index_path)
+        except FileNotFoundError:
+            return
+        signature = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if signature == self._index_signature: return
+            try:
+                with open(self._index_path, "r", encoding="utf-8") as f: index = json.load(f)
+            except (OSError, json.JSONDecodeError) as e:
+                print(f"警告：无法读取模板索引: {e}")
+                return
+            self._index = index.get("templates", {})
+            self._index_signature = signature
+
+    @contextlib.contextmanager
+    def _writing(self):
+        """写操作：加锁后先读取最新索引，避免覆盖其它进程刚写入的模板。可以嵌套，只在最外层写索引。"""
+        with self._lock:
+            if self._write_depth:
+                yield
+                return
+            with _file_lock(os.path.join(self.directory, ".lock")):
+                self._refresh_index()
+                self._write_depth += 1
+                try: yield
+                finally: self._write_depth -= 1
+                _atomic_write_json(self._index_path, {"format": 1, "templates": self._index})
+                self._refresh_index()
+
+    def _read_file(self, path):
+        with open(path, "r", encoding="utf-8") as f: return json.load(f)
+
+    def __getitem__(self, name):
+        self._refresh_index()
+        with self._lock:
+            entry = self._index.get(name)
+            if entry is None: raise KeyError(name)
+            cached = self._cache.get(name)
+            if cached and cached[0] == entry["version"]: return cached[1]
+        try:
+            settings = self._read_file(os.path.join(self.directory, entry["file"]))["settings"]
+        except (OSError, json.JSONDecodeError, KeyError) as e:
+            print(f"警告：无法读取模板 '{name}': {e}")
+            raise KeyError(name) from e
+        with self._lock: self._cache[name] = (entry["version"], settings)
+        return settings
+
+    def __setitem__(self, name, settings):
+        with self._writing():
+            old = self._index.get(name)
+            # 删除后重新创建时从历史中最大的版本号继续，不会覆盖已归档的版本
+            version = max(self._history_versions(name) + ([old["version"]] if old else []), default=0) + 1
+            file_name = self._file_id(name) + ".json"
+            if old: self._archive(name, old)
+            _atomic_write_json(os.path.join(self.directory, file_name),
+                               {"name": name, "version": version, "saved": time.time(), "settings": settings})
+            self._index[name] = {"file": file_name, "version": version}
+            self._cache[name] = (version, settings)
+
+    def __delitem__(self, name):
+        with self._writing():
+            entry = self._index.pop(name)  # 不存在时抛出 KeyError
+            self._cache.pop(name, None)
+            self._archive(name, entry)
+            try: os.remove(os.path.join(self.directory, entry["file"]))
+            except FileNotFoundError: pass
+
+    def __iter__(self):
+        self._refresh_index()
+        with self._lock: return iter(list(self._index))
+
+    def __len__(self):
+        self._refresh_index()
+        return len(self._index)
+
+    def __contains__(self, name):
+        self._refresh_index()
+        return name in self._index
+
+    def _archive(self, name, entry):
+        """把当前版本移到 history，并删除超出数量上限的旧版本。"""
+        if name.startswith(_SESSION_PREFIX): return
+        current = os.path.join(self.directory, entry["file"])
+        history_dir = os.path.join(self.directory, "history", self._file_id(name))
+        os.makedirs(history_dir, exist_ok=True)
+        try: _clone_file(current, os.path.join(history_dir, f"{entry['version']}.json"))
+        except FileNotFoundError: return
+        for old in sorted(self._history_versions(name))[:-TEMPLATE_HISTORY_LIMIT]:
+            os.remove(os.path.join(history_dir, f"{old}.json"))
+
+    def _history_versions(self, name):
+        history_dir = os.path.join(self.directory, "history", self._file_id(name))
+        try: names = os.listdir(history_dir)
+        except FileNotFoundError: return []
+        return [int(n[:-5]) for n in names if n.endswith(".json") and n[:-5].isdigit()]
+
+    def history(self, name):
+        """返回模板的历史版本号（从旧到新），当前版本不在其中。"""
+        return sorted(self._history_versions(name))
+
+    def version(self, name, version):
+        """读取模板的某个历史版本。"""
+        path = os.path.join(self.directory, "history", self._file_id(name), f"{version}.json")
+        try: return self._read_file(path)["settings"]
+        except FileNotFoundError: raise KeyError(f"{name}@{version}") from None
+
+    def restore(self, name, version):
+        """把历史版本恢复为当前版本（作为新版本保存，原来的当前版本进入历史）。"""
+        self[name] = self.version(name, version)
+
+    def import_legacy(self, legacy_file):
+        """导入旧的单文件 watermark_templates.json（原文件保留不动），返回导入的模板数。"""
+        try:
+            with open(legacy_file, "r", encoding="utf-8") as f: templates = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError): return 0
+        with self._writing():  # 整个迁移持有锁，多个进程同时启动时只迁移一次
+            if self._index: return 0
+            for name, settings in templates.items():
+                self[name] = settings
+        print(f"已把 {len(templates)} 个模板从 {legacy_file} 迁移到 {self.directory}")
+        return len(templates)
+
+def load_templates(settings_file):
+    """
+    打开模板存储。settings_file 可以是存储目录，也可以是旧的 watermark_templates.json：
+    后者对应同名（去掉扩展名）的目录，存储还不存在时自动导入旧文件中的模板。
+    """
+    if settings_file.lower().endswith(".json"):
+        directory = os.path.splitext(settings_file)[0]
+        is_new = not os.path.exists(os.path.join(directory, "index.json"))
+        store = TemplateStore(directory)
+        if is_new: store.import_legacy(settings_file)
+        return store
+    return TemplateStore(settings_file)
+
+# --- 性能分析：--profile 或环境变量 WATERMARK_PROFILE=cprofile|sample ---
+PROFILE_MODES = ("cprofile", "sample")
+PROFILE_MODE = os.environ.get("WATERMARK_PROFILE", "").lower()
+PROFILE_DIR = os.environ.get("WATERMARK_PROFILE_DIR", "watermark_profile")
+_SAMPLE_INTERVAL = 0.005
+_SIMD_FLAGS = ("sse2", "sse4_1", "sse4_2", "avx", "avx2", "avx512f", "asimd", "neon")
+_PROFILE_SESSION = None  # 当前进程中正在记录的会话目录，嵌套的会话直接复用
+_ACTIVE_PROFILE_RUN = None
+
+class _StackSampler:
+    """采样分析器：后台线程定时抓取本进程所有线程的调用栈，按折叠栈格式（flamegraph.pl、speedscope 可读）计数。"""
+    def __init__(self, interval=_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def start(self): self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.counts[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.counts.items(): f.write(f"{stack} {count}\n")
+
+class _ProfileRun:
+    """在一个进程内记录一段代码的分析数据，结束时写入会话目录（每个进程、每次记录一个文件）。"""
+    def __init__(self, directory, label, mode):
+        self.directory, self.label, self.mode = directory, label, mode
+
+    def __enter__(self):
+        global _ACTIVE_PROFILE_RUN
+        inherited = _ACTIVE_PROFILE_RUN
+        if inherited and inherited.pid != os.getpid() and inherited.mode == "cprofile":
+            inherited.profiler.disable()  # fork 出的工作进程继承了主进程已启用的分析器，先关闭再开始自己的记录
+            inherited = None
+        self.previous, self.pid = inherited, os.getpid()
+        _ACTIVE_PROFILE_RUN = self
+        self.profiler = cProfile.Profile() if self.mode == "cprofile" else _StackSampler()
+        if self.mode == "cprofile": self.profiler.enable()
+        else: self.profiler.start()
+        return self
+
+    def __exit__(self, *exc):
+        global _ACTIVE_PROFILE_RUN
+        _ACTIVE_PROFILE_RUN = self.previous
+        name = f"{self.label}-{os.getpid()}-{time.time_ns()}"
+        if self.mode == "cprofile":
+            self.profiler.disable()
+            self.profiler.dump_stats(os.path.join(self.directory, name + ".pstats"))
+        else:
+            self.profiler.stop()
+            self.profiler.dump(os.path.join(self.directory, name + ".collapsed"))
+
+def _cpu_simd_flags():
+    """CPU 支持的 SIMD 指令集（读取 /proc/cpuinfo，其它平台返回空列表）。"""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            flags = set()
+            for line in f:
+                if line.startswith(("flags", "Features")): flags.update(line.split(":", 1)[1].split())
+    except OSError:
+        return []
+    return [flag for flag in _SIMD_FLAGS if flag in flags]
+
+def profile_environment(image_paths=(), limit=1000):
+    """记录分析时的运行环境：Python/Pillow 版本和编译特性、SIMD 支持、CPU 核数、图片尺寸。"""
+    import PIL
+    from PIL import features
+    images = []
+    for path in list(image_paths)[:limit]:
+        try:
+            with _open_unchecked(path) as img:  # 只读取文件头，大图模式支持的超大图片也要能记录
+                images.append({"path": path, "size": img.size, "mode": img.mode, "format": img.format,
+                               "frames": getattr(img, "n_frames", 1), "bytes": os.path.getsize(path)})
+        except (OSError, ValueError) as e:
+            images.append({"path": path, "error": str(e)})
+    return {
+        "python": sys.version, "platform": platform.platform(), "machine": platform.machine(),
+        "cpu_count": os.cpu_count(), "cpu_simd": _cpu_simd_flags(),
+        "pillow": PIL.__version__, "pillow_simd": ".post" in PIL.__version__,
+        "pillow_features": {name: features.version(name) for name in features.get_supported()},
+        "numpy": np.__version__, "memory_budget_mb": MEMORY_BUDGET_MB,
+        "image_count": len(image_paths), "images": images,
+    }
+
+def write_profile_report(directory, mode, image_paths, wall_time):
+    """合并会话目录中各进程的分析文件，并写出运行环境信息。"""
+    files = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+    if mode == "cprofile":
+        parts = [path for path in files if path.endswith(".pstats")]
+        if parts:
+            stats = pstats.Stats(*parts)
+            stats.dump_stats(os.path.join(directory, "merged.pstats"))
+            with open(os.path.join(directory, "summary.txt"), "w", encoding="utf-8") as f:
+                stats.stream = f
+                stats.sort_stats("cumulative").print_stats(60)
+    else:
+        merged = Counter()
+        for path in files:
+            if not path.endswith(".collapsed"): continue
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    stack, _, count = line.rstrip("\n").rpartition(" ")
+                    merged[stack] += int(count)
+        with open(os.path.join(directory, "merged.collapsed"), "w", encoding="utf-8") as f:
+            for stack, count in merged.most_common(): f.write(f"{stack} {count}\n")
+    environment = profile_environment(image_paths)
+    environment.update(mode=mode, wall_time=wall_time)
+    with open(os.path.join(directory, "environment.json"), "w", encoding="utf-8") as f:
+        json.dump(environment, f, ensure_ascii=False, indent=2)
+    print(f"性能分析结果已保存到 {directory}")
+
+@contextlib.contextmanager
+def profile_session(label, image_paths=(), mode=None):
+    """
+    未开启性能分析时什么也不做（返回 None）；开启时在本进程内记录，返回会话目录，
+    工作进程把各自的分析文件写入同一目录，结束时合并。image_paths 可以是返回路径列表的函数。
+    已有会话在记录时（如图形界面会话中执行批量处理）直接复用该会话。
+    """
+    global _PROFILE_SESSION
+    mode = mode or PROFILE_MODE
+    if mode not in PROFILE_MODES or _PROFILE_SESSION:
+        yield _PROFILE_SESSION
+        return
+    directory = os.path.abspath(os.path.join(PROFILE_DIR, f"{label}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"))
+    os.makedirs(directory, exist_ok=True)
+    _PROFILE_SESSION = (directory, mode)
+    start = time.perf_counter()
+    try:
+        with _ProfileRun(directory, label, mode):
+            yield _PROFILE_SESSION
+    finally:
+        _PROFILE_SESSION = None
+        write_profile_report(directory, mode, image_paths() if callable(image_paths) else image_paths,
+                             time.perf_counter() - start)
+
+# --- 批量处理：按文件头估算耗时，最长的任务先做，多进程并行 ---
+# 每像素耗时（纳秒，粗略实测值），只用于任务之间的相对比较
+_DECODE_NS_PER_PIXEL = {"JPEG": 8, "PNG": 35, "TIFF": 3, "WEBP": 37, "GIF": 12}
+_ENCODE_NS_PER_PIXEL = {"jpg": 7, "jpeg": 7, "png": 370, "gif": 15, "webp": 40, "tiff": 3}
+_STYLE_DRAWS = {"无": 1, "阴影": 2, "描边": 9}  # 每种样式绘制文字的次数
+_TASK_OVERHEAD_NS = 2_000_000  # 打开文件、读取 EXIF 等固定开销
+
+def estimate_cost(fpath, plan, renditions=None):
+    """只读取文件头估算处理耗时（纳秒）：像素数 × 解码/编码系数 × 帧数，加上图章绘制和固定开销。"""
+    try:
+        with _open_unchecked(fpath) as img:
+            width, height, fmt = img.width, img.height, img.format
+            frames = img.n_frames if getattr(img, "is_animated", False) else 1
+    except (OSError, ValueError):
+        return _TASK_OVERHEAD_NS
+    pixels = width * height
+    out_format = MULTIFRAME_FORMATS.get(fmt, plan.output_format) if frames > 1 else plan.output_format
+    outputs = [1.0]
+    if renditions:
+        long_edge = max(width, height)
+        outputs = [min(1, (r.get("max_size") or long_edge) / long_edge) ** 2 for r in renditions]
+    encode = sum(_ENCODE_NS_PER_PIXEL.get(out_format, 50) * pixels * area for area in outputs)
+    stamp = plan.font_size_for(width, height) ** 2 * len(plan.text) * _STYLE_DRAWS.get(plan.style, 1) * 2
+    return _TASK_OVERHEAD_NS + frames * (_DECODE_NS_PER_PIXEL.get(fmt, 30) * pixels + encode + stamp * len(outputs))
+
+def schedule_batch(costs):
+    """
+    按估算耗时从大到小排序（LPT），交给进程池后等价于“谁空闲谁取下一个最长任务”。
+    耗时按 2 的幂分档，同一档内按文件夹和文件名排列，让同一文件夹的文件相邻处理，利于顺序读取。
+    costs: {path: 估算耗时}，返回排好序的路径列表。
+    """
+    def key(path):
+        cost = costs[path]
+        return (-math.floor(math.log2(max(cost, 1))), os.path.dirname(path), os.path.basename(path))
+    return sorted(costs, key=key)
+
+def _batch_task(fpath, plan, renditions, output_dir, naming_rule, custom_text, profile=None):
+    """工作进程中处理一个文件，返回 (输出路径列表, 耗时, 错误信息)。profile 为 (会话目录, 模式) 时记录本任务。"""
+    if profile:
+        with _ProfileRun(profile[0], "worker", profile[1]):
+            return _batch_task(fpath, plan, renditions, output_dir, naming_rule, custom_text)
+    start = time.perf_counter()
+    try:
+        cache = get_output_cache()
+        if renditions:
+            out_paths = render_renditions(fpath, plan, renditions, output_dir, naming_rule, custom_text, cache)
+        else:
+            out_paths = [render_file(fpath, plan, output_dir, naming_rule, custom_text, cache=cache)]
+        return [p for p in out_paths if p], time.perf_counter() - start, None
+    except Exception as e:
+        return [], time.perf_counter() - start, str(e)
+
+def run_batch(plans, output_dir, naming_rule="保持原名", custom_text="", renditions=None, workers=None):
+    """
+    并行处理 {path: RenderPlan}。先按文件头估算耗时并排序，再交给进程池；
+    同时运行的任务估算内存（estimate_memory）之和不超过 MEMORY_BUDGET_MB，放不下的文件排队等待。
+    结束后报告实际完成时间（makespan）与下界 max(总耗时 / 进程数, 最长任务) 的比值。
+    返回 {path: 输出路径列表}。
+    """
+    with profile_session("batch", list(plans)) as profile:
+        return _run_batch(plans, output_dir, naming_rule, custom_text, renditions, workers, profile)
+
+def _run_batch(plans, output_dir, naming_rule, custom_text, renditions, workers, profile):
+    workers = max(1, min(workers or os.cpu_count() or 1, len(plans) or 1))
+    costs = {path: estimate_cost(path, plan, renditions) for path, plan in plans.items()}
+    order = schedule_batch(costs)
+    results, durations = {}, {}
+    start = time.perf_counter()
+
+    def collect(fpath, result):
+        out_paths, elapsed, error = result
+        durations[fpath] = elapsed
+        results[fpath] = out_paths
+        if error: print(f"{os.path.basename(fpath)} 处理失败: {error}")
+        for out_path in out_paths: print(f"已保存: {out_path}")
+
+    if workers == 1:
+        date_paths = [p for p in order if plans[p].text == "使用拍摄日期"]
+        if date_paths: prefetch_exif_dates(date_paths)
+        for fpath in order:
+            collect(fpath, _batch_task(fpath, plans[fpath], renditions, output_dir, naming_rule, custom_text))
+    else:
+        # 按顺序提交，同时运行的任务估算内存之和不超过预算：放不下的大文件排队等待，
+        # 期间由后面较小的文件补位；没有任务在运行时总能提交一个
+        memory = {path: estimate_memory(path, plan, renditions=renditions) for path, plan in plans.items()}
+        gate = MemoryGate()
+        pending, running = list(order), {}
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            while pending or running:
+                for fpath in list(pending):
+                    if len(running) >= workers: break
+                    if not gate.fits(memory[fpath]): continue
+                    future = pool.submit(_batch_task, fpath, plans[fpath], renditions, output_dir, naming_rule, custom_text, profile)
+                    running[future] = fpath
+                    gate.used += memory[fpath]
+                    pending.remove(fpath)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    fpath = running.pop(future)
+                    gate.used -= memory[fpath]
+                    collect(fpath, future.result())
+
+    makespan = time.perf_counter() - start
+    if durations:
+        total = sum(durations.values())
+        lower_bound = max(total / workers, max(durations.values()))
+        print(f"批量处理完成：{len(durations)} 个文件，{workers} 个进程，用时 {makespan:.2f}s，"
+              f"下界 {lower_bound:.2f}s（效率 {lower_bound / makespan:.0%}，任务总耗时 {total:.2f}s）")
+    return results
+
+def same_folder(a, b):
+    """两个路径是否指向同一个文件夹（解析符号链接，Windows 上不区分大小写）。"""
+    return os.path.normcase(os.path.realpath(a)) == os.path.normcase(os.path.realpath(b))
+
+# --- 监视文件夹模式：持续为新放入输入文件夹的图片添加水印 ---
+class _InotifyWatch:
+    """基于 ctypes 的最小 inotify 封装，仅在 Linux 上可用。"""
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    _EVENT_HEADER = 16  # struct inotify_event: int wd; uint32 mask, cookie, len
+
+    def __init__(self, path):
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), self.IN_CLOSE_WRITE | self.IN_MOVED_TO)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"无法监视 {path}")
+
+    def read_names(self, timeout):
+        """等待最多 timeout 秒，返回期间写完或移入的文件名列表。"""
+        import select
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names, offset = [], 0
+        while offset + self._EVENT_HEADER <= len(data):
+            name_len = int.from_bytes(data[offset + 12:offset + 16], sys.byteorder)
+            raw_name = data[offset + self._EVENT_HEADER:offset + self._EVENT_HEADER + name_len]
+            names.append(os.fsdecode(raw_name.rstrip(b"\0")))
+            offset += self._EVENT_HEADER + name_len
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+class FolderWatcher:
+    """
+    监视输入文件夹，文件写入完成后立即用指定设置添加水印。
+    - Linux 上优先使用 inotify（写入关闭即触发），其它平台回退为 mtime/大小快照轮询。
+    - 轮询模式下，文件的大小和修改时间在两次扫描间保持不变才视为写入完成。
+    - 使用线程池并行处理突发到达的文件，字体和水印图章缓存在整个会话中保持预热；
+      同时处理的文件估算内存之和不超过 MEMORY_BUDGET_MB。
+    """
+    def __init__(self, input_dir, output_dir, settings, output_format="jpg", naming_rule="保持原名",
+                 custom_text="", workers=None, poll_interval=0.2, use_inotify=True, renditions=None):
+        self.input_dir = os.path.abspath(input_dir)
+        self.output_dir = output_dir
+        if same_folder(self.input_dir, output_dir):
+            raise ValueError("输出文件夹不能和监视的文件夹相同，以防覆盖原图并反复处理自己的输出")
+        self.plan = compile_render_plan(settings, output_format)
+        self.naming_rule = naming_rule
+        self.custom_text = custom_text
+        self.renditions = renditions
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._processed = {}   # path -> 已处理版本的 (mtime_ns, size)
+        self._in_flight = set()
+        self._dirty = set()    # 处理期间又被修改、完成后需要重新处理的文件
+        self._pending = {}     # 轮询模式：path -> 上次扫描的 (mtime_ns, size)
+        self._written = set()  # 本监视器写出的文件，之后的写入事件不再处理
+        self._memory = MemoryGate()  # 突发到达的大图排队处理，同时解码的总内存不超过预算
+
+    def _scan(self):
+        snapshot = {}
+        try:
+            entries = os.scandir(self.input_dir)
+        except FileNotFoundError:
+            return snapshot
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.name.lower().endswith(SUPPORTED_EXTENSIONS):
+                    continue
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        snapshot[entry.path] = (st.st_mtime_ns, st.st_size)
+                except FileNotFoundError:
+                    continue
+        return snapshot
+
+    def _signature(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def submit(self, path, detected_at=None):
+        detected_at = detected_at or time.perf_counter()
+        signature = self._signature(path)
+        if signature is None or signature[1] == 0:
+            return
+        with self._lock:
+            if self._processed.get(path) == signature or os.path.realpath(path) in self._written:
+                return
+            if path in self._in_flight:
+                self._dirty.add(path)
+                return
+            self._in_flight.add(path)
+        self.executor.submit(self._process, path, signature, detected_at)
+
+    def _process(self, path, signature, detected_at):
+        out_paths = []
+        try:
+            with self._memory.reserve(estimate_memory(path, self.plan, renditions=self.renditions)):
+                out_paths = self._render(path)
+            for out_path in filter(None, out_paths):
+                print(f"已保存: {out_path} ({time.perf_counter() - detected_at:.3f}s)")
+        except Exception as e:
+            print(f"{os.path.basename(path)} 处理失败: {e}")
+        with self._lock:
+            self._written.update(os.path.realpath(p) for p in out_paths if p)
+            self._processed[path] = signature
+            self._in_flight.discard(path)
+            again = path in self._dirty
+            self._dirty.discard(path)
+        if again:
+            self.submit(path)
+
+    def _render(self, path):
+        if self.renditions:
+            return render_renditions(path, self.plan, self.renditions, self.output_dir,
+                                     self.naming_rule, self.custom_text, get_output_cache())
+        return [render_file(path, self.plan, self.output_dir, self.naming_rule, self.custom_text, cache=get_output_cache())]
+
+    def _poll_once(self):
+        snapshot = self._scan()
+        now = time.perf_counter()
+        for path, signature in snapshot.items():
+            if self._pending.get(path) == signature:
+                self.submit(path, now)
+        self._pending = snapshot
+
+    def run(self, process_existing=False):
+        os.makedirs(self.output_dir, exist_ok=True)
+        existing = self._scan()
+        if process_existing:
+            for path in existing: self.submit(path)
+        else:
+            self._processed.update(existing)
+        self._pending = existing
+
+        watch = None
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try: watch = _InotifyWatch(self.input_dir)
+            except OSError as e: print(f"inotify 不可用，改用轮询: {e}")
+        print(f"正在监视 {self.input_dir}（{'inotify' if watch else '轮询'}），按 Ctrl+C 退出...")
+        try:
+            while not self._stop.is_set():
+                if watch:
+                    for name in watch.read_names(self.poll_interval * 5):
+                        if not name.startswith('.') and name.lower().endswith(SUPPORTED_EXTENSIONS):
+                            self.submit(os.path.join(self.input_dir, name))
+                else:
+                    self._poll_once()
+                    self._stop.wait(self.poll_interval)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if watch: watch.close()
+            self.executor.shutdown(wait=True)
+
+    def stop(self):
+        self._stop.set()
+
+# --- 本地 HTTP 渲染服务：在内存中完成 字节串输入 -> 字节串输出，不落临时文件 ---
+def _warm_worker(templates):
+    """工作进程初始化：预先加载模板用到的字体和水印图章。"""
+    for settings in templates.values():
+        try:
+            plan = compile_render_plan(settings)
+            if plan.text and plan.text != "使用拍摄日期" and not plan.font_scale:
+                render_stamp(plan.text, plan.font_path, plan.font_size, plan.color, plan.alpha, plan.style, plan.outline_color)
+        except Exception:
+            continue
+
+def _ping():
+    return os.getpid()
+
+def _render_request(data, plan):
+    start = time.perf_counter()
+    out_bytes, _ = watermark_bytes(data, plan, plan.output_format)
+    return out_bytes, time.perf_counter() - start
+
+class RenderService:
+    """
+    本地水印渲染服务。
+    - POST /render?template=模板名&format=jpg|png[&text=覆盖文本]，请求体为图片字节，返回带水印的图片。
+      也可以用 X-Watermark-Settings 头传入完整的设置 JSON。
+    - GET /metrics 返回纯文本计数器，GET /healthz 用于存活检查。
+    渲染在启动时预先创建好的进程池中进行，每个进程的字体和图章缓存保持预热；
+    设置无效、模板不存在、Content-Length 为负数、请求体无法识别为图片或像素数超过 Pillow 的解压炸弹上限时返回 400；
+    超过 max_body 的请求返回 413，并发超过 max_concurrency 时返回 503。
+    """
+    def __init__(self, templates, host="127.0.0.1", port=8765, workers=None, max_body=50 * 1024 * 1024,
+                 max_concurrency=None):
+        from http.server import ThreadingHTTPServer
+
+        self.templates = templates
+        self.max_body = max_body
+        workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_warm_worker, initargs=(templates,))
+        # 预先拉起全部工作进程，避免第一批请求承担进程启动和缓存预热的开销
+        for future in [self.pool.submit(_ping) for _ in range(workers)]: future.result()
+        self._slots = threading.BoundedSemaphore(max_concurrency or workers * 2)
+        self._metrics_lock = threading.Lock()
+        self.metrics = {"requests_total": 0, "responses_ok": 0, "rejected_too_large": 0, "rejected_busy": 0,
+                        "errors_total": 0, "in_flight": 0, "bytes_in": 0, "bytes_out": 0, "render_seconds_sum": 0.0}
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def _count(self, **deltas):
+        with self._metrics_lock:
+            for key, value in deltas.items(): self.metrics[key] += value
+
+    def _settings_from_request(self, query, headers):
+        raw = headers.get("X-Watermark-Settings")
+        if raw:
+            settings = json.loads(raw)
+            if not isinstance(settings, dict): raise ValueError("X-Watermark-Settings 必须是 JSON 对象")
+        else:
+            name = query.get("template", ["默认模板 (右下角阴影)"])[0]
+            if name not in self.templates: raise ValueError(f"未找到模板 '{name}'")
+            settings = dict(self.templates[name])
+        if "text" in query: settings["text"] = query["text"][0]
+        return settings
+
+    def _make_handler(self):
+        from http.server import BaseHTTPRequestHandler
+        from urllib.parse import urlsplit, parse_qs
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, status, body, content_type="text/plain; charset=utf-8", headers=None):
+                if isinstance(body, str): body = body.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                for key, value in (headers or {}).items(): self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlsplit(self.path).path
+                if path == "/metrics":
+                    with service._metrics_lock: snapshot = dict(service.metrics)
+                    self._reply(200, "".join(f"watermark_{key} {value}\n" for key, value in snapshot.items()))
+                elif path == "/healthz":
+                    self._reply(200, "ok\n")
+                else:
+                    self._reply(404, "not found\n")
+
+            def do_POST(self):
+                url = urlsplit(self.path)
+                if url.path != "/render": self._reply(404, "not found\n"); return
+                service._count(requests_total=1)
+                try: length = int(self.headers.get("Content-Length", ""))
+                except ValueError: self._reply(411, "需要 Content-Length\n"); return
+                if length < 0:
+                    # rfile.read(-1) 会一直读到客户端断开，占住并发名额
+                    self.close_connection = True
+                    self._reply(400, "Content-Length 不能为负数\n"); return
+                if length > service.max_body:
+                    service._count(rejected_too_large=1)
+                    self.close_connection = True
+                    self._reply(413, f"请求体超过上限 {service.max_body} 字节\n"); return
+                if not service._slots.acquire(blocking=False):
+                    service._count(rejected_busy=1)
+                    self.close_connection = True
+                    self._reply(503, "服务繁忙，请稍后重试\n", headers={"Retry-After": "1"}); return
+                service._count(in_flight=1)
+                try:
+                    data = self.rfile.read(length)
+                    query = parse_qs(url.query)
+                    output_format = query.get("format", ["jpg"])[0].lower()
+                    plan = compile_render_plan(service._settings_from_request(query, self.headers), output_format)
+                    out_bytes, seconds = service.pool.submit(_render_request, data, plan).result()
+                except (ValueError, Image.UnidentifiedImageError, Image.DecompressionBombError) as e:
+                    # 设置无效、模板不存在、请求体不是可识别的图片或像素数超出上限都属于客户端错误
+                    service._count(errors_total=1)
+                    self._reply(400, f"{e}\n")
+                except Exception as e:
+                    service._count(errors_total=1)
+                    self._reply(500, f"渲染失败: {e}\n")
+                else:
+                    service._count(responses_ok=1, bytes_in=length, bytes_out=len(out_bytes), render_seconds_sum=seconds)
+                    content_type = "image/png" if output_format == "png" else "image/jpeg"
+                    self._reply(200, out_bytes, content_type, {"X-Render-Seconds": f"{seconds:.4f}"})
+                finally:
+                    service._count(in_flight=-1)
+                    service._slots.release()
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve_forever(self):
+        print(f"水印渲染服务已启动: http://{self.address[0]}:{self.address[1]}/render")
+        try:
+            self.httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.pool.shutdown(wait=True)
+
+# --- 缩略图缓存与虚拟文件列表：内存占用与所选图片数量无关 ---
+THUMBNAIL_SIZE = (400, 400)
+THUMBNAIL_CACHE_MB = float(os.environ.get("WATERMARK_THUMBNAIL_CACHE_MB", 256))
+
+def _image_nbytes(img):
+    return img.width * img.height * len(img.getbands()) if img is not None else 0
+
+class ByteLRUCache:
+    """按字节数限制容量的 LRU 缓存，超出上限时淘汰最久未使用的条目，线程安全。"""
+    def __init__(self, max_bytes, sizeof=_image_nbytes):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        with self._lock:
+            if key in self._items:
+                self.total_bytes -= self._items.pop(key)[1]
+            self._items[key] = (value, size)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self._items) > 1:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.total_bytes -= evicted_size
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.total_bytes = 0
+
+def load_thumbnail(img_path, size=THUMBNAIL_SIZE):
+    """生成缩略图（JPEG 会按 DCT 缩放解码），并及时关闭文件句柄。"""
+    with Image.open(img_path) as img:
+        img.thumbnail(size)
+        return img.copy()
+
+def load_proxy(img_path, size):
+    """生成预览用的代理图（JPEG 按 DCT 缩放解码），返回 (代理图, 原图宽度)。"""
+    with Image.open(img_path) as img:
+        original_width = img.width
+        img.draft("RGB", size)
+        img.thumbnail(size)
+        has_alpha = img.has_transparency_data
+        return img.convert("RGBA" if has_alpha else "RGB"), original_width
+
+def render_proxy(img_path, plan, size, proxies=None):
+    """
+    在代理图上按比例缩放的渲染计划盖水印，用于批量预览。
+    proxies 为 ByteLRUCache 时缓存未加水印的代理图，换模板后不必重新解码；
+    同一批图片尺寸相同时缩放后的计划相同，图章也只栅格化一次。
+    """
+    cached = proxies.get(img_path) if proxies is not None else None
+    if cached is None:
+        cached = load_proxy(img_path, size)
+        if proxies is not None: proxies.put(img_path, cached)
+    proxy, original_width = cached
+    if plan is None:
+        return proxy
+    proxy_plan = plan.scaled(proxy.width / original_width)
+    text = proxy_plan.resolve_text(img_path) or proxy_plan.text
+    return proxy_plan.apply(proxy.copy(), text) if text else proxy
+
+class VirtualFileList(ttk.Frame):
+    """
+    虚拟化的文件列表：只把当前可见的几行放进 Listbox，滚动时再替换内容，
+    因此几万个文件也不会一次性创建全部列表项。接口与 Listbox 的单选用法保持一致。
+    """
+    def __init__(self, master, height=10, width=50, on_select=None):
+        super().__init__(master)
+        self.on_select = on_select
+        self.items = []
+        self.top = 0
+        self.selected = None
+        self.rows = height
+        self.listbox = tk.Listbox(self, height=height, width=width, selectmode=tk.SINGLE, exportselection=False)
+        self.scrollbar = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.listbox.bind("<<ListboxSelect>>", self._on_listbox_select)
+        self.listbox.bind("<Configure>", self._on_resize)
+        self.listbox.bind("<MouseWheel>", lambda e: self.scroll(-1 if e.delta > 0 else 1, "units"))
+        self.listbox.bind("<Button-4>", lambda e: self.scroll(-1, "units"))
+        self.listbox.bind("<Button-5>", lambda e: self.scroll(1, "units"))
+        self.listbox.bind("<Up>", lambda e: self._move_selection(-1))
+        self.listbox.bind("<Down>", lambda e: self._move_selection(1))
+
+    def set_items(self, items):
+        self.items = list(items)
+        self.top = 0
+        self.selected = None
+        self._render()
+
+    def visible_range(self):
+        return self.top, min(len(self.items), self.top + self.rows)
+
+    def curselection(self):
+        return (self.selected,) if self.selected is not None else ()
+
+    def selection_set(self, index):
+        self.selected = index
+        if index < self.top or index >= self.top + self.rows:
+            self.top = max(0, min(index, len(self.items) - self.rows))
+        self._render()
+
+    def scroll(self, amount, what):
+        step = amount * (self.rows if what == "pages" else 1)
+        self.top = max(0, min(self.top + step, len(self.items) - self.rows))
+        self._render()
+        return "break"
+
+    def _on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.top = max(0, min(int(float(args[0]) * len(self.items)), len(self.items) - self.rows))
+            self._render()
+        elif action == "scroll":
+            self.scroll(int(args[0]), args[1])
+
+    def _on_resize(self, event):
+        line_height = tkfont.Font(font=self.listbox.cget("font")).metrics("linespace") + 1
+        rows = max(1, event.height // line_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.top = max(0, min(self.top, len(self.items) - self.rows))
+            self._render()
+
+    def _render(self):
+        start, end = self.visible_range()
+        self.listbox.delete(0, tk.END)
+        if end > start:
+            self.listbox.insert(tk.END, *self.items[start:end])
+        if self.selected is not None and start <= self.selected < end:
+            self.listbox.selection_set(self.selected - start)
+        total = max(len(self.items), 1)
+        self.scrollbar.set(start / total, end / total if self.items else 1)
+
+    def _on_listbox_select(self, event=None):
+        visible = self.listbox.curselection()
+        if not visible:
+            return
+        self.selected = self.top + visible[0]
+        if self.on_select: self.on_select()
+
+    def _move_selection(self, delta):
+        if not self.items:
+            return "break"
+        index = 0 if self.selected is None else max(0, min(self.selected + delta, len(self.items) - 1))
+        self.selection_set(index)
+        if self.on_select: self.on_select()
+        return "break"
+
+class ContactSheet(tk.Toplevel):
+    """
+    批量预览：按页（默认 48 张）以网格显示加水印后的代理图。
+    代理图在后台线程池中渲染，结果经队列交回主线程、渲染一张显示一张；
+    翻页时取消上一页尚未开始的任务并丢弃其结果，当前页完成后预取下一页的代理图。
+    点击某一格会在主窗口中选中该图片。
+    """
+    COLUMNS, ROWS = 8, 6
+    CELL_SIZE = (160, 120)
+
+    def __init__(self, app, workers=None):
+        super().__init__(app.root)
+        self.app = app
+        self.title("批量预览")
+        self.page = 0
+        self.page_size = self.COLUMNS * self.ROWS
+        self.generation = 0  # 每次翻页或刷新加一，旧任务的结果据此丢弃
+        self.futures = []
+        self.results = queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self.proxies = ByteLRUCache(int(THUMBNAIL_CACHE_MB * 1024 * 1024), sizeof=lambda item: _image_nbytes(item[0]))
+        self.photos = {}
+
+        toolbar = ttk.Frame(self, padding="5")
+        toolbar.pack(fill=tk.X)
+        ttk.Button(toolbar, text="上一页", command=lambda: self.show_page(self.page - 1)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="下一页", command=lambda: self.show_page(self.page + 1)).pack(side=tk.LEFT, padx=5)
+        ttk.Button(toolbar, text="刷新", command=lambda: self.show_page(self.page)).pack(side=tk.LEFT, padx=5)
+        self.status = ttk.Label(toolbar)
+        self.status.pack(side=tk.LEFT, padx=10)
+        grid = ttk.Frame(self, padding="5")
+        grid.pack(fill=tk.BOTH, expand=True)
+        self.cells = []
+        for i in range(self.page_size):
+            cell = ttk.Label(grid, compound=tk.TOP, anchor=tk.CENTER, width=22)
+            cell.grid(row=i // self.COLUMNS, column=i % self.COLUMNS, padx=2, pady=2)
+            cell.bind("<Button-1>", lambda e, i=i: self._select(i))
+            self.cells.append(cell)
+        self.bind("<Prior>", lambda e: self.show_page(self.page - 1))
+        self.bind("<Next>", lambda e: self.show_page(self.page + 1))
+        self.protocol("WM_DELETE_WINDOW", self.close)
+        self.show_page(0)
+        self._poll_id = self.after(30, self._poll)
+
+    def _plan_for(self, path):
+        """与导出规则一致（见 export_settings）：导出时会跳过的图片返回 None，显示不加水印的代理图。"""
+        settings = self.app.export_settings(path)
+        if settings is None: return None
+        try: return compile_render_plan(settings)
+        except ValueError: return None
+
+    def _cancel(self):
+        self.generation += 1
+        for future in self.futures: future.cancel()
+        self.futures = []
+
+    def show_page(self, page):
+        paths = self.app.image_paths
+        pages = max(1, math.ceil(len(paths) / self.page_size))
+        self.page = max(0, min(page, pages - 1))
+        self._cancel()
+        self.photos.clear()
+        start = self.page * self.page_size
+        page_paths = paths[start:start + self.page_size]
+        for i, cell in enumerate(self.cells):
+            cell.config(image="", text=os.path.basename(page_paths[i]) if i < len(page_paths) else "")
+        self.pending = len(page_paths)
+        self.page_text = f"第 {self.page + 1}/{pages} 页，共 {len(paths)} 张"
+        self.status.config(text=self.page_text)
+        generation = self.generation
+        for i, path in enumerate(page_paths):
+            self.futures.append(self.executor.submit(self._render, generation, i, path, self._plan_for(path)))
+        # 线程池按提交顺序执行，下一页的代理图排在当前页之后预取
+        for path in paths[start + self.page_size:start + 2 * self.page_size]:
+            self.futures.append(self.executor.submit(render_proxy, path, None, self.CELL_SIZE, self.proxies))
+
+    def _render(self, generation, index, path, plan):
+        if generation != self.generation: return
+        try: image = render_proxy(path, plan, self.CELL_SIZE, self.proxies)
+        except Exception as e: print(f"{os.path.basename(path)} 预览失败: {e}"); image = None
+        self.results.put((generation, index, image))
+
+    def _poll(self):
+        try:
+            while True:
+                generation, index, image = self.results.get_nowait()
+                if generation != self.generation: continue
+                self.pending -= 1
+                if image is not None:
+                    self.photos[index] = ImageTk.PhotoImage(image)
+                    self.cells[index].config(image=self.photos[index])
+        except queue.Empty:
+            pass
+        self.status.config(text=self.page_text + (f"（剩余 {self.pending} 张）" if self.pending else ""))
+        self._poll_id = self.after(30, self._poll)
+
+    def _select(self, index):
+        path_index = self.page * self.page_size + index
+        if path_index < len(self.app.image_paths):
+            self.app.file_listbox.selection_set(path_index)
+            self.app.show_thumbnail()
+
+    def close(self):
+        self.after_cancel(self._poll_id)
+        self._cancel()
+        self.executor.shutdown(wait=False)
+        self.destroy()
+
 from tkinter import simpledialog
 
 class WatermarkApp:
@@ -113,7 +2373,8 @@ class WatermarkApp:
 
         self.image_paths = []
         self.image_settings = {}
-        self.thumbnails = []
+        self.thumbnails = ByteLRUCache(int(THUMBNAIL_CACHE_MB * 1024 * 1024))  # path -> 缩略图
+        self.image_sizes = {}  # path -> 原图尺寸，拖拽时不必每次打开文件
         self.output_dir = tk.StringVar(value="")
         self.input_dir = ""
         self.current_preview_image = None
@@ -125,6 +2386,7 @@ class WatermarkApp:
         self.drag_start_x = 0
         self.drag_start_y = 0
         self._loading_settings = False
+        self.renditions = []  # 多版本输出配置，随模板加载
 
         self.create_widgets()
 
@@ -152,7 +2414,7 @@ class WatermarkApp:
         ttk.Button(output_frame, text="浏览...", command=self.select_output_dir).pack(side=tk.LEFT, padx=5)
         self.list_preview_frame = ttk.Frame(self.root, padding="10")
         self.list_preview_frame.pack(fill=tk.BOTH, expand=True)
-        self.file_listbox = tk.Listbox(self.list_preview_frame, height=10, width=50, selectmode=tk.SINGLE)
+        self.file_listbox = VirtualFileList(self.list_preview_frame, height=10, width=50, on_select=self.show_thumbnail)
         self.file_listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.preview_label = ttk.Label(self.list_preview_frame)
         self.preview_label.pack(side=tk.RIGHT, padx=10, expand=True)
@@ -194,10 +2456,15 @@ class WatermarkApp:
         ttk.Button(position_grid_frame, text="↙", width=3, command=lambda: self.set_position("左下")).grid(row=2, column=0)
         ttk.Button(position_grid_frame, text="↓", width=3, command=lambda: self.set_position("中下")).grid(row=2, column=1)
         ttk.Button(position_grid_frame, text="↘", width=3, command=lambda: self.set_position("右下")).grid(row=2, column=2)
+        ttk.Button(position_grid_frame, text="自动", command=lambda: self.set_position("自动")).grid(row=3, column=0, columnspan=3, sticky=tk.EW)
         ttk.Label(options_frame, text="样式:").grid(row=4, column=0, padx=5, pady=5, sticky=tk.W)
         self.style_combo = ttk.Combobox(options_frame, values=["无", "阴影", "描边"], width=10)
         self.style_combo.grid(row=4, column=1, padx=5, pady=5, sticky=tk.W)
         self.style_combo.set("无")
+        ttk.Label(options_frame, text="混合:").grid(row=4, column=2, padx=5, pady=5, sticky=tk.W)
+        self.blend_combo = ttk.Combobox(options_frame, values=list(BLEND_MODES), width=10, state="readonly")
+        self.blend_combo.grid(row=4, column=3, padx=5, pady=5, sticky=tk.W)
+        self.blend_combo.set("正常")
         output_settings_frame = ttk.Frame(self.root, padding="10")
         output_settings_frame.pack(fill=tk.X)
         ttk.Label(output_settings_frame, text="输出格式:").pack(side=tk.LEFT, padx=5)
@@ -221,13 +2488,14 @@ class WatermarkApp:
         ttk.Button(template_frame, text="删除选中模板", command=self._delete_template).pack(side=tk.LEFT, padx=5)
         bottom_frame = ttk.Frame(self.root, padding="10")
         bottom_frame.pack(fill=tk.X)
+        ttk.Button(bottom_frame, text="批量预览", command=self.open_contact_sheet).pack(side=tk.LEFT, padx=5)
         ttk.Button(bottom_frame, text="应用水印", command=self.apply_watermarks).pack()
         self.text_entry.bind("<KeyRelease>", self.update_preview)
         self.font_combo.bind("<<ComboboxSelected>>", self.update_preview)
         self.font_size_entry.bind("<KeyRelease>", self.update_preview)
         self.style_combo.bind("<<ComboboxSelected>>", self.update_preview)
+        self.blend_combo.bind("<<ComboboxSelected>>", self.update_preview)
         self.alpha_scale.config(command=self.update_preview)
-        self.file_listbox.bind("<<ListboxSelect>>", self.show_thumbnail)
 
 
     # --- 新增和修改的核心方法 ---
@@ -248,9 +2516,8 @@ class WatermarkApp:
                 "pos_x": -2,  # 右对齐
                 "pos_y": -2   # 底对齐
             }
-            self.templates[template_name] = default_settings
-            # 创建后立即保存一次，确保它持久化
-            self._save_templates_to_file()
+            # 存储在赋值时立即原子写入，确保它持久化
+            self._store_template(template_name, default_settings)
 
     def _load_startup_settings(self):
         """修改：加载启动设置，优先加载上次会话，否则加载默认模板。"""
@@ -268,27 +2535,33 @@ class WatermarkApp:
 
     # --- 以下是您原有的模板管理和辅助方法，保持不变 ---
     def _on_close(self):
-        print("正在保存上次会话的设置..."); last_settings = self._get_current_ui_settings(); self.templates["__last_session__"] = last_settings; self._save_templates_to_file(); self.root.destroy()
+        print("正在保存上次会话的设置..."); last_settings = self._get_current_ui_settings(); self._store_template("__last_session__", last_settings); self.root.destroy()
+    def _read_font_size(self):
+        """字号输入框支持像素值（36）或短边的百分比（5%），格式不对时抛出 ValueError。"""
+        value = self.font_size_entry.get().strip()
+        if value.endswith("%"): float(value[:-1]); return value
+        return int(value)
     def _get_current_ui_settings(self):
-        try: font_size = int(self.font_size_entry.get())
+        try: font_size = self._read_font_size()
         except (ValueError, TypeError): font_size = 36
-        return {"text": self.text_entry.get(), "font_name": self.font_combo.get(), "font_size": font_size, "text_color": self.text_color.get(), "outline_color": self.outline_color.get(), "alpha": self.alpha_scale.get(), "style": self.style_combo.get(), "pos_x": self.position_x, "pos_y": self.position_y}
+        settings = {"text": self.text_entry.get(), "font_name": self.font_combo.get(), "font_size": font_size, "text_color": self.text_color.get(), "outline_color": self.outline_color.get(), "alpha": self.alpha_scale.get(), "style": self.style_combo.get(), "blend_mode": self.blend_combo.get(), "pos_x": self.position_x, "pos_y": self.position_y}
+        if self.renditions: settings["renditions"] = self.renditions
+        return settings
     def _apply_settings_to_ui(self, settings):
         self._loading_settings = True
         self.text_entry.delete(0, tk.END); self.text_entry.insert(0, settings.get("text", ""))
         self.font_combo.set(settings.get("font_name", "Arial")); self.font_size_entry.delete(0, tk.END); self.font_size_entry.insert(0, str(settings.get("font_size", 36)))
-        self.text_color.set(settings.get("text_color", "255,255,255")); self.outline_color.set(settings.get("outline_color", "0,0,0")); self.alpha_scale.set(settings.get("alpha", 80.0)); self.style_combo.set(settings.get("style", "无"))
+        self.text_color.set(settings.get("text_color", "255,255,255")); self.outline_color.set(settings.get("outline_color", "0,0,0")); self.alpha_scale.set(settings.get("alpha", 80.0)); self.style_combo.set(settings.get("style", "无")); self.blend_combo.set(settings.get("blend_mode", "正常"))
         self.position_x = settings.get("pos_x", 10); self.position_y = settings.get("pos_y", 10)
+        self.renditions = settings.get("renditions", [])
         self._loading_settings = False
         if self.active_index is not None: self.save_current_settings(); self.update_preview()
     def _load_templates_from_file(self):
-        try:
-            with open(self.settings_file, 'r', encoding='utf-8') as f: self.templates = json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError): self.templates = {}
-    def _save_templates_to_file(self):
-        try:
-            with open(self.settings_file, 'w', encoding='utf-8') as f: json.dump(self.templates, f, indent=4, ensure_ascii=False)
-        except Exception as e: print(f"保存模板失败: {e}")
+        self.templates = load_templates(self.settings_file)
+    def _store_template(self, name, settings):
+        """只写入这一个模板（临时文件 + 重命名），返回是否成功。"""
+        try: self.templates[name] = settings; return True
+        except OSError as e: print(f"保存模板失败: {e}"); return False
     def _populate_template_combo(self):
         template_names = [name for name in self.templates.keys() if name != "__last_session__"]; self.template_combo['values'] = sorted(template_names); self.template_combo.set("")
     def _save_template(self):
@@ -296,7 +2569,9 @@ class WatermarkApp:
         if template_name:
             if template_name == "__last_session__": messagebox.showerror("错误", "该名称为内部保留，请使用其他名称。"); return
             if template_name in self.templates and not messagebox.askyesno("确认", f"模板 '{template_name}' 已存在，要覆盖吗？"): return
-            current_settings = self._get_current_ui_settings(); self.templates[template_name] = current_settings; self._save_templates_to_file(); self._populate_template_combo(); self.template_combo.set(template_name); messagebox.showinfo("成功", f"模板 '{template_name}' 已保存。")
+            current_settings = self._get_current_ui_settings()
+            if not self._store_template(template_name, current_settings): messagebox.showerror("错误", f"模板 '{template_name}' 保存失败。"); return
+            self._populate_template_combo(); self.template_combo.set(template_name); messagebox.showinfo("成功", f"模板 '{template_name}' 已保存。")
     def _load_template(self, event=None):
         template_name = self.template_combo.get()
         if template_name and template_name in self.templates:
@@ -306,27 +2581,38 @@ class WatermarkApp:
         if not template_name: messagebox.showwarning("提示", "请先在下拉菜单中选择一个要删除的模板。"); return
         if template_name in self.templates:
             if messagebox.askyesno("确认删除", f"确定要删除模板 '{template_name}' 吗？此操作无法撤销。"):
-                del self.templates[template_name]; self._save_templates_to_file(); self._populate_template_combo(); messagebox.showinfo("成功", f"模板 '{template_name}' 已删除。")
-    def get_default_settings(self): return { "text": "", "font_name": "Arial", "font_size": 36, "text_color": "255,255,255", "outline_color": "0,0,0", "alpha": 80.0, "style": "无", "pos_x": 10, "pos_y": 10 }
+                try: del self.templates[template_name]
+                except OSError as e: messagebox.showerror("错误", f"删除模板失败: {e}"); return
+                self._populate_template_combo(); messagebox.showinfo("成功", f"模板 '{template_name}' 已删除。")
+    def get_default_settings(self): return { "text": "", "font_name": "Arial", "font_size": 36, "text_color": "255,255,255", "outline_color": "0,0,0", "alpha": 80.0, "style": "无", "blend_mode": "正常", "pos_x": 10, "pos_y": 10 }
     def update_ui_with_files(self):
-        self.file_listbox.delete(0, tk.END); self.thumbnails.clear(); self.active_index = None; self.preview_label.config(image=""); self.current_preview_image = None
+        self.thumbnails.clear(); self.active_index = None; self.preview_label.config(image=""); self.current_preview_image = None
         if self.input_dir: self.output_dir.set(os.path.join(self.input_dir, os.path.basename(self.input_dir) + "_watermarked"))
         else: self.output_dir.set("")
         current_paths = set(self.image_paths)
         self.image_settings = {path: settings for path, settings in self.image_settings.items() if path in current_paths}
-        for i, fpath in enumerate(self.image_paths):
-            self.file_listbox.insert(tk.END, os.path.basename(fpath))
-            if fpath not in self.image_settings: self.image_settings[fpath] = self.get_default_settings()
-            try: img = Image.open(fpath); img.thumbnail((400, 400)); self.thumbnails.append(img)
-            except Exception: self.thumbnails.append(None)
-        if self.thumbnails: self.file_listbox.selection_set(0); self.show_thumbnail()
+        # 列表只保存文件名，缩略图和默认设置都在第一次用到时才创建
+        self.file_listbox.set_items([os.path.basename(fpath) for fpath in self.image_paths])
+        if self.image_paths: self.file_listbox.selection_set(0); self.show_thumbnail()
+    def get_thumbnail(self, path):
+        thumb = self.thumbnails.get(path)
+        if thumb is None:
+            try: thumb = load_thumbnail(path)
+            except Exception: return None
+            self.thumbnails.put(path, thumb)
+        return thumb
+    def get_image_size(self, path):
+        size = self.image_sizes.get(path)
+        if size is None:
+            with Image.open(path) as img: size = self.image_sizes[path] = img.size  # 只读取文件头
+        return size
     def load_settings_for_image(self, path):
-        if path not in self.image_settings: return
+        if path not in self.image_settings: self.image_settings[path] = self.get_default_settings()
         self._loading_settings = True
         settings = self.image_settings[path]
         self.text_entry.delete(0, tk.END); self.text_entry.insert(0, settings["text"])
         self.font_combo.set(settings["font_name"]); self.font_size_entry.delete(0, tk.END); self.font_size_entry.insert(0, str(settings["font_size"]))
-        self.text_color.set(settings["text_color"]); self.outline_color.set(settings["outline_color"]); self.alpha_scale.set(settings["alpha"]); self.style_combo.set(settings["style"])
+        self.text_color.set(settings["text_color"]); self.outline_color.set(settings["outline_color"]); self.alpha_scale.set(settings["alpha"]); self.style_combo.set(settings["style"]); self.blend_combo.set(settings.get("blend_mode", "正常"))
         self.position_x = settings["pos_x"]; self.position_y = settings["pos_y"]
         self._loading_settings = False
     def save_current_settings(self):
@@ -335,9 +2621,9 @@ class WatermarkApp:
         if path not in self.image_settings: self.image_settings[path] = self.get_default_settings()
         settings = self.image_settings[path]
         settings["text"] = self.text_entry.get(); settings["font_name"] = self.font_combo.get()
-        try: settings["font_size"] = int(self.font_size_entry.get())
+        try: settings["font_size"] = self._read_font_size()
         except ValueError: pass
-        settings["text_color"] = self.text_color.get(); settings["outline_color"] = self.outline_color.get(); settings["alpha"] = self.alpha_scale.get(); settings["style"] = self.style_combo.get()
+        settings["text_color"] = self.text_color.get(); settings["outline_color"] = self.outline_color.get(); settings["alpha"] = self.alpha_scale.get(); settings["style"] = self.style_combo.get(); settings["blend_mode"] = self.blend_combo.get()
         settings["pos_x"] = self.position_x; settings["pos_y"] = self.position_y
     def show_thumbnail(self, event=None):
         selected_indices = self.file_listbox.curselection()
@@ -357,33 +2643,21 @@ class WatermarkApp:
         if not settings: return
 
         try:
-            font_path = self.get_font_path(settings["font_name"])
-            text_color = tuple(map(int, settings["text_color"].split(',')))
-            outline_color = tuple(map(int, settings["outline_color"].split(',')))
-            
+            # 相同设置的渲染计划已缓存，拖动和输入时不会重复解析
+            plan = compile_render_plan(settings)
+
             # 如果没有水印文字，直接显示原始缩略图
             if not settings["text"]:
-                thumb = self.thumbnails[self.active_index]
+                thumb = self.get_thumbnail(original_image_path)
                 if thumb:
                     self.current_preview_image = ImageTk.PhotoImage(thumb)
                     self.preview_label.config(image=self.current_preview_image)
                 return
 
-            # --- 核心修复：正确处理 add_watermark 返回的两个值 ---
+            preview_text = plan.resolve_text(original_image_path) or plan.text
+
             # 我们只需要第一个返回值（图片对象），用 _ 来忽略第二个返回值（EXIF数据）
-            watermarked_image, _ = add_watermark(
-                original_image_path, 
-                settings["text"], 
-                font_path, 
-                settings["font_size"], 
-                text_color, 
-                settings["alpha"], 
-                settings["pos_x"],
-                settings["pos_y"], 
-                settings["style"], 
-                outline_color
-            )
-            # --- 修复结束 ---
+            watermarked_image, _ = plan.render(original_image_path, preview_text)
             
             watermarked_image.thumbnail((400, 400))
             self.current_preview_image = ImageTk.PhotoImage(watermarked_image)
@@ -393,7 +2667,7 @@ class WatermarkApp:
             # 打印错误有助于调试
             print(f"预览更新失败: {e}")
             # Fallback: 显示原始缩略图
-            thumb = self.thumbnails[self.active_index]
+            thumb = self.get_thumbnail(original_image_path)
             if thumb:
                 self.current_preview_image = ImageTk.PhotoImage(thumb)
                 self.preview_label.config(image=self.current_preview_image)
@@ -402,23 +2676,28 @@ class WatermarkApp:
         if self.active_index is None: messagebox.showwarning("警告", "请先在列表中选择一张图片。"); return
         fpath = self.image_paths[self.active_index]
         date = get_exif_date(fpath)
+        # 后台预取整个选择的拍摄日期，之后切换图片和导出时直接命中缓存
+        threading.Thread(target=prefetch_exif_dates, args=(list(self.image_paths),), daemon=True).start()
         if date: self.text_entry.delete(0, tk.END); self.text_entry.insert(0, date); self.update_preview()
         else: messagebox.showinfo("提示", "所选图片没有拍摄时间信息。")
     def on_drag_start(self, event): self.drag_start_x = event.x; self.drag_start_y = event.y
     def on_drag(self, event):
         if self.active_index is None: return
         try:
-            original_img = Image.open(self.image_paths[self.active_index]); original_w, original_h = original_img.size
+            path = self.image_paths[self.active_index]; original_w, original_h = self.get_image_size(path)
             preview_w = self.current_preview_image.width(); preview_h = self.current_preview_image.height()
             scale_x = original_w / preview_w; scale_y = original_h / preview_h
-            watermark_text = self.text_entry.get(); font_path = self.get_font_path(self.font_combo.get()); font_size = int(self.font_size_entry.get())
-            font = ImageFont.truetype(font_path, font_size)
-            bbox = ImageDraw.Draw(Image.new("RGBA", (0,0))).textbbox((0,0), watermark_text, font=font)
-            text_w = bbox[2] - bbox[0]; text_h = bbox[3] - bbox[1]
+            watermark_text = self.text_entry.get()
+            if watermark_text == "使用拍摄日期": watermark_text = get_exif_date(path) or watermark_text
+            # 相对字号和自动位置按本图换算（自动位置用已缓存的缩略图统计），与预览、导出共用同一份排版缓存
+            plan = compile_render_plan(self._get_current_ui_settings()).for_image(
+                original_w, original_h, watermark_text, lambda: luminance_proxy(self.get_thumbnail(path)))
+            bbox = plan.layout(watermark_text).ink
         except Exception: return
+        # 锚点（居中/靠右/自动等）先换算为当前的绝对坐标，再开始拖动
+        start_x, start_y = plan.position(original_w, original_h, watermark_text)
         dx = (event.x - self.drag_start_x) * scale_x; dy = (event.y - self.drag_start_y) * scale_y
-        new_x = self.position_x + dx; new_y = self.position_y + dy
-        self.position_x = max(0, min(new_x, original_w - text_w)); self.position_y = max(0, min(new_y, original_h - text_h))
+        self.position_x, self.position_y = clamp_position(start_x + dx, start_y + dy, original_w, original_h, bbox)
         self.drag_start_x = event.x; self.drag_start_y = event.y
         self.update_preview()
     def get_font_names(self):
@@ -429,8 +2708,7 @@ class WatermarkApp:
             except: continue
         font_names.sort(); return font_names
     def get_font_path(self, font_name):
-        try: prop = FontProperties(family=font_name); return findfont(prop)
-        except Exception: return "arial.ttf"
+        return get_font_path(font_name)
     def choose_color(self):
         color_code = colorchooser.askcolor(title="选择文本颜色")
         if color_code and color_code[0]: rgb = color_code[0]; self.text_color.set(f"{int(rgb[0])},{int(rgb[1])},{int(rgb[2])}"); self.update_preview()
@@ -446,9 +2724,9 @@ class WatermarkApp:
                 self.input_dir = dir_path
                 for fname in os.listdir(dir_path):
                     fpath = os.path.join(dir_path, fname)
-                    if os.path.isfile(fpath) and fname.lower().endswith(('.jpg', '.jpeg', '.png')): new_paths.append(fpath)
+                    if os.path.isfile(fpath) and fname.lower().endswith(SUPPORTED_EXTENSIONS): new_paths.append(fpath)
         else:
-            file_paths = filedialog.askopenfilenames(filetypes=[("Image files", "*.jpg *.jpeg *.png")])
+            file_paths = filedialog.askopenfilenames(filetypes=[("Image files", "*.jpg *.jpeg *.png *.tif *.tiff *.gif *.webp")])
             if file_paths:
                 new_paths.extend(file_paths)
                 if len(set(os.path.dirname(p) for p in file_paths)) == 1: self.input_dir = os.path.dirname(file_paths[0])
@@ -469,6 +2747,7 @@ class WatermarkApp:
         elif pos_key == "左下": self.position_x, self.position_y = 10, -2
         elif pos_key == "中下": self.position_x, self.position_y = -1, -2
         elif pos_key == "右下": self.position_x, self.position_y = -2, -2
+        elif pos_key == "自动": self.position_x, self.position_y = AUTO_POSITION, AUTO_POSITION  # 每张图片选最不杂乱的角
         self.update_preview()
     def handle_dnd(self, event):
         dropped_paths_str = event.data
@@ -482,62 +2761,170 @@ class WatermarkApp:
                 self.input_dir = path
                 for fname in os.listdir(path):
                     fpath = os.path.join(path, fname)
-                    if os.path.isfile(fpath) and fname.lower().endswith(('.jpg', '.jpeg', '.png')): temp_paths.append(fpath)
-            elif os.path.isfile(path) and path.lower().endswith(('.jpg', '.jpeg', '.png')):
+                    if os.path.isfile(fpath) and fname.lower().endswith(SUPPORTED_EXTENSIONS): temp_paths.append(fpath)
+            elif os.path.isfile(path) and path.lower().endswith(SUPPORTED_EXTENSIONS):
                 temp_paths.append(path)
                 if len(set(os.path.dirname(p) for p in dropped_paths)) == 1: self.input_dir = os.path.dirname(dropped_paths[0])
                 else: self.input_dir = None
         if temp_paths: self.image_paths = temp_paths; self.update_ui_with_files()
+    def open_contact_sheet(self):
+        if not self.image_paths: messagebox.showwarning("警告", "请先选择图片。"); return
+        if self.active_index is not None: self.save_current_settings()
+        ContactSheet(self)
+    def export_settings(self, fpath):
+        """导出时使用的设置：没有单独设置或水印文本为空的图片返回 None（导出时跳过，批量预览中不加水印）。"""
+        settings = self.image_settings.get(fpath)
+        return settings if settings and settings["text"] else None
+
     def apply_watermarks(self):
         if not self.image_paths: messagebox.showwarning("警告", "请先选择图片。"); return
         output_dir = self.output_dir.get()
         if not output_dir: messagebox.showerror("错误", "请指定一个输出文件夹。"); return
-        if self.input_dir and os.path.abspath(output_dir) == os.path.abspath(self.input_dir): messagebox.showerror("错误", "输出文件夹不能和原文件夹相同，以防覆盖原图。"); return
+        if self.input_dir and same_folder(output_dir, self.input_dir): messagebox.showerror("错误", "输出文件夹不能和原文件夹相同，以防覆盖原图。"); return
         try: output_format = self.format_combo.get().lower(); naming_rule = self.naming_combo.get(); custom_text = self.prefix_entry.get()
         except ValueError: messagebox.showerror("错误", "参数格式不正确。"); return
-        os.makedirs(output_dir, exist_ok=True)
+        try: renditions = resolve_renditions(self.renditions, self.templates, output_format)
+        except ValueError as e: messagebox.showerror("错误", str(e)); return
+        # 先把每张图片的设置编译为渲染计划，设置有误时在开始处理前一次性报告
+        plans, invalid = {}, []
         for fpath in self.image_paths:
-            fname = os.path.basename(fpath); settings = self.image_settings.get(fpath)
-            if not settings or not settings["text"]: print(f"{fname} 水印文本为空或无设置，跳过"); continue
-            try:
-                final_text = settings["text"]
-                if final_text == "使用拍摄日期": date = get_exif_date(fpath); final_text = date if date else ""
-                if not final_text: print(f"{fname} 水印文本为空，跳过"); continue
-                font_path = self.get_font_path(settings["font_name"]); text_color = tuple(map(int, settings["text_color"].split(','))); outline_color = tuple(map(int, settings["outline_color"].split(',')))
-                # add_watermark 现在返回图片和EXIF
-                watermarked_img, exif_bytes = add_watermark(fpath, final_text, font_path, settings["font_size"], 
-                    text_color, settings["alpha"], settings["pos_x"], 
-                    settings["pos_y"], settings["style"], outline_color
-                )
-                
-                base_name, _ = os.path.splitext(fname)
-                if naming_rule == "添加前缀":
-                    new_fname = f"{custom_text}{base_name}.{output_format}"
-                elif naming_rule == "添加后缀":
-                    new_fname = f"{base_name}{custom_text}.{output_format}"
-                else:
-                    new_fname = f"{base_name}.{output_format}"
-                
-                out_path = os.path.join(output_dir, new_fname)
-
-                # --- 核心修复：根据格式和EXIF数据进行保存 ---
-                if output_format.lower() in ['jpg', 'jpeg']:
-                    if exif_bytes:
-                        watermarked_img.save(out_path, format='jpeg', exif=exif_bytes)
+            fname = os.path.basename(fpath); settings = self.export_settings(fpath)
+            if settings is None: print(f"{fname} 水印文本为空或无设置，跳过"); continue
+            try: plans[fpath] = compile_render_plan(settings, output_format)
+            except ValueError as e: invalid.append(f"{fname}: {e}")
+        if invalid: messagebox.showerror("设置无效", "以下图片的水印设置有误，请修改后重试：\n" + "\n".join(invalid[:10])); return
+        os.makedirs(output_dir, exist_ok=True)
+        run_batch(plans, output_dir, naming_rule, custom_text, renditions)
+        messagebox.showinfo("完成", f"所有图片处理完毕！\n文件已保存至：{output_dir}")
+
+# --- 合成性能对比 ---
+def _legacy_full_layer(img, x, y, text, font, fill, style, outline_fill):
+    """旧做法：整图转 RGBA，新建同尺寸透明图层绘制文字，整图合成后再转回 RGB。"""
+    base = img.convert("RGBA")
+    layer = Image.new("RGBA", base.size, (255, 255, 255, 0))
+    _draw_watermark_text(ImageDraw.Draw(layer), (x, y), text, font, fill, style, outline_fill)
+    return Image.alpha_composite(base, layer).convert("RGB")
+
+def benchmark_blend(sizes=((1920, 1080), (4000, 3000), (8000, 6000)), repeat=5):
+    """对比整图图层合成与区域 NumPy 合成的耗时，并确认两者输出一致。"""
+    font_path = get_font_path("Arial")
+    for width, height in sizes:
+        img = Image.new("RGB", (width, height), (90, 120, 150))
+        for style in WATERMARK_STYLES:
+            text, font_size, alpha = "© Benchmark 2024", max(12, height // 30), 80.0
+            color, outline = (255, 255, 255), (0, 0, 0)
+            x, y = resolve_position(-2, -2, width, height, text_layout(text, font_path, font_size).ink)
+            fill = color + (int(alpha * 255 / 100),)
+            timings = []
+            for func in ("legacy", "region"):
+                best = float("inf")
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    if func == "legacy":
+                        legacy = _legacy_full_layer(img, x, y, text, load_font(font_path, font_size), fill, style, outline + (fill[3],))
                     else:
-                        watermarked_img.save(out_path, format='jpeg')
-                elif output_format.lower() == 'png':
-                    # PNG 保持RGBA，不能带exif
-                    watermarked_img.save(out_path, format='png')
-                else:
-                    watermarked_img.save(out_path, format=output_format)
+                        region = stamp_watermark(img.copy(), x, y, text, font_path, font_size, color, alpha, style, outline)
+                    best = min(best, time.perf_counter() - start)
+                timings.append(best)
+            same = "一致" if legacy.tobytes() == region.tobytes() else "不一致"
+            print(f"{width}x{height} {style}: 整图 {timings[0] * 1000:.1f} ms, 区域 {timings[1] * 1000:.1f} ms "
+                  f"(含整图复制), 加速 {timings[0] / timings[1]:.1f}x, 输出{same}")
 
-                print(f"已保存: {out_path}")
-            except Exception as e: print(f"{fname} 处理失败: {e}")
-        messagebox.showinfo("完成", f"所有图片处理完毕！\n文件已保存至：{output_dir}")
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片水印工具，不带参数时启动图形界面。")
+    parser.add_argument("--watch", metavar="输入文件夹", help="监视模式：持续为放入该文件夹的新图片添加水印")
+    parser.add_argument("--batch", nargs="+", metavar="文件或文件夹", help="批量模式：用模板为这些图片（或文件夹中的图片）并行添加水印")
+    parser.add_argument("--output", metavar="输出文件夹", help="输出文件夹（监视模式默认为 <输入文件夹>_watermarked，批量模式必须指定）")
+    parser.add_argument("--template", default="默认模板 (右下角阴影)", help="使用 watermark_templates.json 中的模板名称")
+    parser.add_argument("--templates-file", default="watermark_templates.json", help="模板存储目录，或旧的模板 JSON 文件（首次使用时自动迁移到同名目录）")
+    parser.add_argument("--format", default="jpg", choices=["jpg", "png"])
+    parser.add_argument("--naming", default="保持原名", choices=["保持原名", "添加前缀", "添加后缀"])
+    parser.add_argument("--affix", default="", help="添加前缀/后缀时使用的文本")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--memory-budget-mb", type=float, default=None, help="单张图片处理的内存预算，超出时使用分段处理")
+    parser.add_argument("--poll-interval", type=float, default=0.2, help="轮询模式的扫描间隔（秒）")
+    parser.add_argument("--existing", action="store_true", help="启动时也处理文件夹中已有的图片")
+    parser.add_argument("--serve", action="store_true", help="启动本地 HTTP 渲染服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-body-mb", type=float, default=50, help="单个请求体的大小上限（MB）")
+    parser.add_argument("--max-concurrency", type=int, default=None, help="同时处理的请求数上限")
+    parser.add_argument("--cache-dir", default=None, help="启用输出缓存并指定缓存文件夹（也可用环境变量 WATERMARK_CACHE_DIR）")
+    parser.add_argument("--cache-mb", type=float, default=None, help="输出缓存的大小上限（MB，默认 2048）")
+    parser.add_argument("--benchmark", action="store_true", help="对比整图图层合成与区域合成的耗时")
+    parser.add_argument("--profile", nargs="?", const="cprofile", choices=PROFILE_MODES,
+                        help="记录批量处理或图形界面会话的性能分析数据（也可用环境变量 WATERMARK_PROFILE）")
+    parser.add_argument("--profile-dir", default=None, help="性能分析结果的保存位置（默认 watermark_profile）")
+    args = parser.parse_args(argv)
+    global PROFILE_MODE, PROFILE_DIR
+    if args.profile: PROFILE_MODE = os.environ["WATERMARK_PROFILE"] = args.profile
+    if args.profile_dir: PROFILE_DIR = os.environ["WATERMARK_PROFILE_DIR"] = args.profile_dir
+    if args.cache_dir: os.environ["WATERMARK_CACHE_DIR"] = args.cache_dir
+    if args.cache_mb: os.environ["WATERMARK_CACHE_MB"] = str(args.cache_mb)
+    if args.memory_budget_mb:
+        # 同时写入环境变量：spawn 方式启动的工作进程（Windows/macOS、打包的 exe）在导入时从环境变量读取
+        global MEMORY_BUDGET_MB
+        MEMORY_BUDGET_MB = args.memory_budget_mb
+        os.environ["WATERMARK_MEMORY_BUDGET_MB"] = str(args.memory_budget_mb)
+
+    if args.benchmark:
+        benchmark_blend()
+        return
+
+
+    if args.serve:
+        service = RenderService(load_templates(args.templates_file), args.host, args.port, args.workers,
+                                int(args.max_body_mb * 1024 * 1024), args.max_concurrency)
+        service.serve_forever()
+        return
+
+    if args.batch:
+        # 先检查文件夹再打开模板存储，参数有误时不创建或迁移存储目录
+        if not args.output: parser.error("批量模式需要用 --output 指定输出文件夹")
+        for path in args.batch:
+            if same_folder(path if os.path.isdir(path) else os.path.dirname(os.path.abspath(path)), args.output):
+                parser.error(f"输出文件夹不能和原文件夹相同，以防覆盖原图: {path}")
+        templates = load_templates(args.templates_file)
+        if args.template not in templates: parser.error(f"未找到模板 '{args.template}'")
+        paths = []
+        for path in args.batch:
+            if os.path.isdir(path):
+                paths.extend(sorted(os.path.join(path, name) for name in os.listdir(path)
+                                    if not name.startswith('.') and name.lower().endswith(SUPPORTED_EXTENSIONS)))
+            elif os.path.isfile(path):
+                paths.append(path)
+        settings = templates[args.template]
+        try:
+            plan = compile_render_plan(settings, args.format)
+            renditions = resolve_renditions(settings.get("renditions", []), templates, args.format)
+        except ValueError as e:
+            parser.error(f"模板 '{args.template}' 设置无效: {e}")
+        os.makedirs(args.output, exist_ok=True)
+        run_batch({os.path.abspath(p): plan for p in paths}, args.output, args.naming, args.affix, renditions, args.workers)
+        return
+
+    if args.watch:
+        # 先检查文件夹再打开模板存储，参数有误时不创建或迁移存储目录
+        input_dir = os.path.abspath(args.watch)
+        output_dir = args.output or os.path.join(input_dir, os.path.basename(input_dir) + "_watermarked")
+        if same_folder(input_dir, output_dir): parser.error("输出文件夹不能和监视的文件夹相同，以防覆盖原图")
+        templates = load_templates(args.templates_file)
+        if args.template not in templates: parser.error(f"未找到模板 '{args.template}'")
+        settings = templates[args.template]
+        try:
+            watcher = FolderWatcher(input_dir, output_dir, settings, args.format, args.naming, args.affix, args.workers,
+                                    args.poll_interval, renditions=resolve_renditions(settings.get("renditions", []), templates, args.format))
+        except ValueError as e:
+            parser.error(f"模板 '{args.template}' 设置无效: {e}")
+        watcher.run(process_existing=args.existing)
+        return
 
-if __name__ == "__main__":
     # Use TkinterDnD.Tk() for the main window
     root = TkinterDnD.Tk()
     app = WatermarkApp(root)
-    root.mainloop()
\ No newline at end of file
+    with profile_session("gui", lambda: app.image_paths):  # 记录整个预览会话，包括其中的批量处理
+        root.mainloop()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()  # 打包为 exe 后工作进程需要
+    main()
\ No newline at end of file
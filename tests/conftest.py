@@ -0,0 +1,59 @@
+import os
+import sys
+import importlib.util
+
+import numpy as np
+import piexif
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _load_app():
+    """WaterMark2.Final.py 的文件名不是合法的模块名，按路径加载；注册到 sys.modules 以便工作进程反序列化渲染计划。"""
+    if "watermark_app" in sys.modules:
+        return sys.modules["watermark_app"]
+    spec = importlib.util.spec_from_file_location("watermark_app", os.path.join(ROOT, "WaterMark2.Final.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["watermark_app"] = module
+    spec.loader.exec_module(module)
+    return module
+
+wm = _load_app()
+
+CORPUS_SIZE = (1280, 960)
+CORPUS_EXIF = {"0th": {piexif.ImageIFD.Make: b"Regress", piexif.ImageIFD.Model: b"Corpus-1", piexif.ImageIFD.Orientation: 1},
+               "Exif": {piexif.ExifIFD.DateTimeOriginal: b"2024:05:01 12:34:56"}}
+
+def base_settings(**overrides):
+    settings = {"text": "© Regress 2024", "font_name": "Arial", "font_size": 28, "text_color": "255,255,255",
+                "outline_color": "200,30,30", "alpha": 73.0, "style": "阴影", "blend_mode": "正常", "pos_x": 10, "pos_y": 10}
+    settings.update(overrides)
+    return settings
+
+def make_corpus(directory, size=CORPUS_SIZE):
+    """确定性的合成语料：带 EXIF 的 JPEG、灰度 JPEG、RGB PNG、半透明 RGBA PNG。"""
+    os.makedirs(directory, exist_ok=True)
+    width, height = size
+    rng = np.random.default_rng(2024)
+    ramp = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    pixels = np.clip(ramp * np.array([1.0, 0.6, 0.3]) + rng.normal(0, 18, (height, width, 3)), 0, 255).astype(np.uint8)
+    pixels[height // 3:height // 2, width // 4:width // 2] = (30, 160, 220)
+    rgb = Image.fromarray(pixels, "RGB")
+    paths = {name: os.path.join(directory, name) for name in ("exif.jpg", "gray.jpg", "rgb.png", "alpha.png")}
+    rgb.save(paths["exif.jpg"], quality=92, exif=piexif.dump(CORPUS_EXIF))
+    rgb.convert("L").save(paths["gray.jpg"], quality=92)
+    rgb.save(paths["rgb.png"])
+    alpha = Image.fromarray(np.tile(np.linspace(0, 255, height, dtype=np.uint8)[:, None], (1, width)), "L")
+    rgba = rgb.convert("RGBA"); rgba.putalpha(alpha); rgba.save(paths["alpha.png"])
+    return paths
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    return make_corpus(str(tmp_path_factory.mktemp("corpus")))
+
+@pytest.fixture
+def small_jpeg(tmp_path):
+    path = str(tmp_path / "small.jpg")
+    Image.new("RGB", (200, 120), (90, 120, 150)).save(path, exif=piexif.dump(CORPUS_EXIF))
+    return path
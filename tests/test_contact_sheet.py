@@ -0,0 +1,15 @@
+from types import SimpleNamespace
+
+from conftest import wm, base_settings
+
+def _sheet(image_settings):
+    """不创建窗口，只用批量预览和导出共用的设置规则。"""
+    app = SimpleNamespace(image_settings=image_settings, _get_current_ui_settings=lambda: base_settings(text="界面设置"))
+    app.export_settings = lambda path: wm.WatermarkApp.export_settings(app, path)
+    return SimpleNamespace(app=app)
+
+def test_images_skipped_by_export_are_previewed_without_watermark():
+    sheet = _sheet({"set.jpg": base_settings(text="© Set"), "empty.jpg": base_settings(text="")})
+    assert wm.ContactSheet._plan_for(sheet, "set.jpg").text == "© Set"
+    assert wm.ContactSheet._plan_for(sheet, "unset.jpg") is None
+    assert wm.ContactSheet._plan_for(sheet, "empty.jpg") is None
@@ -0,0 +1,67 @@
+import io
+
+import piexif
+import pytest
+from PIL import Image
+
+from conftest import wm
+
+def _jpeg(exif=None, extra_app=b"", size=16):
+    buffer = io.BytesIO()
+    Image.effect_noise((size, size), 64).convert("RGB").save(buffer, format="jpeg", **({"exif": exif} if exif else {}))
+    data = buffer.getvalue()
+    return data[:2] + extra_app + data[2:]
+
+def _exif(date=b"2023:07:08 09:10:11", **kwargs):
+    return piexif.dump({"0th": {piexif.ImageIFD.Make: b"Maker"}, "Exif": {piexif.ExifIFD.DateTimeOriginal: date}}, **kwargs)
+
+def test_reads_date_from_header():
+    assert wm.read_exif_date_fast(_jpeg(_exif())) == "2023.07.08"
+
+def _big_endian_exif(date):
+    """手工构造大端（MM）的 Exif 段：IFD0 只有指向 Exif IFD 的指针，Exif IFD 只有 DateTimeOriginal。"""
+    import struct
+    value = date + b"\0"
+    ifd0 = struct.pack(">H", 1) + struct.pack(">HHII", 0x8769, 4, 1, 26) + struct.pack(">I", 0)
+    exif_ifd = struct.pack(">H", 1) + struct.pack(">HHII", piexif.ExifIFD.DateTimeOriginal, 2, len(value), 44) + struct.pack(">I", 0)
+    return b"Exif\0\0" + b"MM\0\x2a" + struct.pack(">I", 8) + ifd0 + exif_ifd + value
+
+def test_big_endian_exif():
+    assert wm.read_exif_date_fast(_jpeg(_big_endian_exif(b"2021:01:02 03:04:05"))) == "2021.01.02"
+
+def test_skips_other_app_segments():
+    app0 = b"\xff\xe0" + (2 + 14).to_bytes(2, "big") + b"JFIF\0" + b"\0" * 9
+    assert wm.read_exif_date_fast(_jpeg(_exif(), extra_app=app0)) == "2023.07.08"
+
+def test_missing_exif_or_date():
+    assert wm.read_exif_date_fast(_jpeg()) is None
+    no_date = piexif.dump({"0th": {piexif.ImageIFD.Make: b"Maker"}})
+    assert wm.read_exif_date_fast(_jpeg(no_date)) is None
+
+def test_not_jpeg_raises():
+    with pytest.raises(ValueError):
+        wm.read_exif_date_fast(b"\x89PNG\r\n\x1a\n" + b"\0" * 32)
+
+def test_reads_from_file_object_lazily(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(_jpeg(_exif(), size=512))
+    with open(path, "rb") as f:
+        assert wm.read_exif_date_fast(f) == "2023.07.08"
+        assert f.tell() < path.stat().st_size
+
+def test_get_exif_date_falls_back_and_caches(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(_jpeg(_exif()))
+    assert wm.get_exif_date(str(path)) == "2023.07.08"
+    assert wm.get_exif_date(path.read_bytes()) == "2023.07.08"
+    png = tmp_path / "a.png"
+    Image.new("RGB", (4, 4)).save(png)
+    assert wm.get_exif_date(str(png)) is None
+
+def test_read_exif_segment_round_trips(tmp_path):
+    path = tmp_path / "a.jpg"
+    path.write_bytes(_jpeg(_exif()))
+    segment = wm.read_exif_segment(str(path))
+    assert segment.startswith(b"Exif\0\0")
+    assert piexif.load(segment)["Exif"][piexif.ExifIFD.DateTimeOriginal] == b"2023:07:08 09:10:11"
+    assert wm.read_exif_segment(str(tmp_path / "missing.jpg")) is None
@@ -0,0 +1,99 @@
+import os
+import sys
+import subprocess
+import threading
+
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings, ROOT
+
+def test_open_unchecked_leaves_global_limit_alone(tmp_path, monkeypatch):
+    path = str(tmp_path / "big.png")
+    Image.new("RGB", (64, 64), (10, 20, 30)).save(path)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 1000)
+    with wm._open_unchecked(path) as img:
+        assert img.size == (64, 64)
+        assert Image.MAX_IMAGE_PIXELS == 1000
+        # 其它线程中的 Image.open 仍然检查解压炸弹
+        with pytest.raises(Image.DecompressionBombError):
+            Image.open(path)
+        img.load()
+    assert Image.MAX_IMAGE_PIXELS == 1000
+
+def test_open_unchecked_rejects_unknown_files(tmp_path):
+    path = str(tmp_path / "not-an-image.jpg")
+    with open(path, "wb") as f: f.write(b"plain text, not pixels")
+    with pytest.raises(Image.UnidentifiedImageError):
+        wm._open_unchecked(path)
+
+def test_over_budget_jpeg_is_refused(tmp_path):
+    src = str(tmp_path / "wide.jpg")
+    Image.new("RGB", (1200, 900), (90, 120, 150)).save(src)
+    out = str(tmp_path / "out.jpg")
+    plan = wm.compile_render_plan(base_settings(), "jpg")
+    with pytest.raises(wm.MemoryBudgetError):
+        wm.render_large_file(src, out, plan, "© test", budget_mb=1)
+    assert not os.path.exists(out)
+
+def test_estimate_memory_matches_render_path(tmp_path):
+    plan = wm.compile_render_plan(base_settings(), "png")
+    jpeg, tiff = str(tmp_path / "a.jpg"), str(tmp_path / "a.tif")
+    Image.new("RGB", (1000, 1000)).save(jpeg)
+    Image.new("RGB", (1000, 1000)).save(tiff)
+    assert wm.estimate_memory(jpeg, plan, budget_mb=100) == 1000 * 1000 * wm._STANDARD_BYTES_PER_PIXEL
+    assert wm.estimate_memory(jpeg, plan, budget_mb=2) == 1000 * 1000 * 3
+    assert wm.estimate_memory(tiff, plan, budget_mb=2) == 2 * 1024 * 1024
+
+def test_memory_gate_queues_until_released():
+    gate = wm.MemoryGate(budget_mb=1)
+    entered = threading.Event()
+
+    def second_task():
+        with gate.reserve(800 * 1024):
+            entered.set()
+
+    with gate.reserve(800 * 1024):
+        worker = threading.Thread(target=second_task)
+        worker.start()
+        assert not entered.wait(0.2)
+    assert entered.wait(2)
+    worker.join()
+    # 单个超出预算的请求在空闲时仍能通过，由 render_large_file 自行拒绝
+    with gate.reserve(10 * 1024 * 1024):
+        assert gate.used == 10 * 1024 * 1024
+
+def test_batch_reports_refused_file_and_processes_the_rest(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(wm, "MEMORY_BUDGET_MB", 1)
+    big, small = str(tmp_path / "big.jpg"), str(tmp_path / "small.jpg")
+    Image.new("RGB", (1200, 900), (90, 120, 150)).save(big)
+    Image.new("RGB", (100, 80), (90, 120, 150)).save(small)
+    plan = wm.compile_render_plan(base_settings(), "jpg")
+    out_dir = str(tmp_path / "out")
+    os.makedirs(out_dir)
+    results = wm.run_batch({big: plan, small: plan}, out_dir, workers=2)
+    assert results[big] == [] and len(results[small]) == 1
+    assert "超出内存预算" in capsys.readouterr().out
+
+def test_profile_environment_records_oversized_headers(tmp_path):
+    path = str(tmp_path / "huge.ppm")
+    with open(path, "wb") as f: f.write(b"P6\n15000 15000\n255\n")  # 只有文件头
+    [entry] = wm.profile_environment([path])["images"]
+    assert entry["size"] == (15000, 15000)
+
+def test_cli_budget_reaches_spawned_workers(tmp_path, monkeypatch):
+    monkeypatch.delenv("WATERMARK_MEMORY_BUDGET_MB", raising=False)
+    monkeypatch.setattr(wm, "MEMORY_BUDGET_MB", wm.MEMORY_BUDGET_MB)
+    photos, out = tmp_path / "photos", tmp_path / "out"
+    photos.mkdir()
+    Image.new("RGB", (60, 40), (90, 120, 150)).save(photos / "a.jpg")
+    wm.TemplateStore(str(tmp_path / "templates"))["默认模板 (右下角阴影)"] = base_settings()
+    wm.main(["--memory-budget-mb", "7", "--templates-file", str(tmp_path / "templates"),
+             "--batch", str(photos), "--output", str(out), "--workers", "1"])
+    assert wm.MEMORY_BUDGET_MB == 7
+    # spawn 方式的工作进程重新导入模块，只能从环境变量得到预算
+    code = ("import importlib.util, sys; spec = importlib.util.spec_from_file_location('w', sys.argv[1]); "
+            "m = importlib.util.module_from_spec(spec); spec.loader.exec_module(m); print(m.MEMORY_BUDGET_MB)")
+    result = subprocess.run([sys.executable, "-c", code, os.path.join(ROOT, "WaterMark2.Final.py")],
+                            capture_output=True, text=True, timeout=60, env=dict(os.environ))
+    assert result.stdout.strip() == "7.0"
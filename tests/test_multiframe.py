@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings
+
+COLORS = [(0, 100, 200), (200, 30, 30), (30, 200, 60), (240, 240, 0), (90, 0, 140)]
+PLAN = wm.compile_render_plan(base_settings(text="WM", font_size=40, text_color="255,255,255", alpha=100, style="无"))
+
+def _white_pixels(frame):
+    return int((np.asarray(frame.convert("RGB")) == 255).all(-1).sum())
+
+def test_gif_frames_with_local_palettes_keep_their_colours(tmp_path):
+    src, out = str(tmp_path / "in.gif"), str(tmp_path / "out.gif")
+    frames = [Image.new("RGB", (200, 120), c).quantize(4) for c in COLORS]
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    wm.render_multiframe(src, out, PLAN, "WM")
+    with Image.open(out) as result:
+        assert result.n_frames == len(COLORS)
+        for i, color in enumerate(COLORS):
+            result.seek(i)
+            frame = result.convert("RGB")
+            assert frame.getpixel((190, 110)) == color
+            assert _white_pixels(frame) > 100  # 白色水印没有被映射到调色板中的其它颜色
+
+def test_gif_transparency_is_preserved(tmp_path):
+    src, out = str(tmp_path / "in.gif"), str(tmp_path / "out.gif")
+    frames = []
+    for color in COLORS[:3]:
+        frame = Image.new("RGBA", (200, 120), color + (255,))
+        frame.paste((0, 0, 0, 0), (100, 0, 200, 120))
+        frames.append(frame)
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=100, loop=0, disposal=2)
+    wm.render_multiframe(src, out, PLAN, "WM")
+    with Image.open(out) as result:
+        for i, color in enumerate(COLORS[:3]):
+            result.seek(i)
+            frame = result.convert("RGBA")
+            assert frame.getpixel((150, 60))[3] == 0
+            assert frame.getpixel((50, 110)) == color + (255,)
+
+def test_frame_using_only_global_colours_keeps_global_palette(tmp_path):
+    src = str(tmp_path / "in.gif")
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([v for c in COLORS + [(255, 255, 255)] for v in c])
+    frames = [Image.new("RGB", (200, 120), c).quantize(palette=palette) for c in COLORS[:2]]
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=100, loop=0, optimize=False)
+    with Image.open(src) as source:
+        stamped = wm._StampedFrames(source, PLAN, "WM")
+        frame = Image.new("RGB", (20, 10), COLORS[1])
+        frame.paste((255, 255, 255), (0, 0, 10, 10))
+        out, transparency = stamped._to_palette(frame)
+    assert transparency is None
+    assert out.getpalette() == source_palette(src)
+    assert out.convert("RGB").getpixel((5, 5)) == (255, 255, 255)
+    assert out.convert("RGB").getpixel((15, 5)) == COLORS[1]
+
+def source_palette(path):
+    with Image.open(path) as img: return img.getpalette()
+
+def _two_frame_gif(tmp_path):
+    src = str(tmp_path / "in.gif")
+    frames = [Image.new("RGB", (200, 120), c).quantize(4) for c in COLORS[:2]]
+    frames[0].save(src, save_all=True, append_images=frames[1:], duration=100, loop=0)
+    return src
+
+def test_oversized_animation_is_refused_before_decoding(tmp_path, monkeypatch):
+    src = _two_frame_gif(tmp_path)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 200 * 120 - 1)
+    with pytest.raises(Image.DecompressionBombError):
+        wm.render_file(src, PLAN, str(tmp_path), "添加后缀", "_wm")
+    with pytest.raises(Image.DecompressionBombError):
+        wm.render_renditions(src, PLAN, [{"max_size": 100}], str(tmp_path), "添加后缀", "_wm")
+    assert not [n for n in os.listdir(tmp_path) if "_wm" in n]
+
+def test_animation_over_budget_is_refused(tmp_path, monkeypatch):
+    src = _two_frame_gif(tmp_path)
+    assert wm.estimate_memory(src, PLAN) == 200 * 120 * 5
+    monkeypatch.setattr(wm, "MEMORY_BUDGET_MB", 0.1)  # 单帧约 0.11 MB
+    with pytest.raises(wm.MemoryBudgetError):
+        wm.render_file(src, PLAN, str(tmp_path), "添加后缀", "_wm")
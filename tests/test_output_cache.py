@@ -0,0 +1,70 @@
+import os
+import time
+
+from PIL import Image
+
+from conftest import wm, base_settings
+
+def _source(tmp_path):
+    path = tmp_path / "1.jpg"
+    Image.new("RGB", (200, 100), "gray").save(path)
+    return str(path)
+
+def test_hit_reuses_output_and_counts(tmp_path):
+    src = _source(tmp_path)
+    cache = wm.OutputCache(str(tmp_path / "cache"), 10 ** 8)
+    plan = wm.compile_render_plan(base_settings())
+    first = wm.render_file(src, plan, str(tmp_path), "添加后缀", "_a", cache=cache)
+    second = wm.render_file(src, plan, str(tmp_path), "添加后缀", "_b", cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    with open(first, "rb") as a, open(second, "rb") as b:
+        assert a.read() == b.read()
+
+def test_key_depends_on_settings_and_content(tmp_path):
+    src = _source(tmp_path)
+    cache = wm.OutputCache(str(tmp_path / "cache"), 10 ** 8)
+    plan = wm.compile_render_plan(base_settings())
+    key = cache.key_for(src, plan)
+    assert key != cache.key_for(src, wm.compile_render_plan(base_settings(text="other")))
+    assert key != cache.key_for(src, plan.with_format("png"))
+    Image.new("RGB", (200, 100), "white").save(src)
+    assert key != cache.key_for(src, plan)
+
+def test_rewriting_a_delivery_does_not_touch_cache_or_other_deliveries(tmp_path):
+    """交付的文件与缓存条目不共用 inode：未启用缓存时重新导出到 A，不影响 B 和缓存条目。"""
+    src = _source(tmp_path)
+    a, b = tmp_path / "A", tmp_path / "B"
+    a.mkdir(); b.mkdir()
+    cache = wm.OutputCache(str(tmp_path / "cache"), 10 ** 8)
+    plan = wm.compile_render_plan(base_settings())
+    wm.render_file(src, plan, str(a), "保持原名", "", cache=cache)
+    delivered = wm.render_file(src, plan, str(b), "保持原名", "", cache=cache)
+    assert os.stat(delivered).st_nlink == 1
+    with open(delivered, "rb") as f: original = f.read()
+
+    wm.render_file(src, wm.compile_render_plan(base_settings(text="lalala")), str(a), "保持原名", "")
+    entry = cache._entry_path(cache.key_for(src, plan))
+    with open(delivered, "rb") as f: assert f.read() == original
+    with open(entry, "rb") as f: assert f.read() == original
+
+def test_fetch_keeps_entry_mtime_and_evicts_least_recently_used(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    cache = wm.OutputCache(cache_dir, 10 ** 8)
+    paths = []
+    for i in range(3):
+        path = tmp_path / f"{i}.bin"
+        path.write_bytes(os.urandom(1000))
+        cache.store(f"{i:02d}" + "0" * 62, str(path))
+        paths.append(cache._entry_path(f"{i:02d}" + "0" * 62))
+    old = time.time() - 1000
+    for i, path in enumerate(paths):
+        os.utime(path, (old + i, old + i))
+    mtime = os.stat(paths[0]).st_mtime_ns
+    assert cache.fetch("00" + "0" * 62, str(tmp_path / "out.bin"))
+    assert os.stat(paths[0]).st_mtime_ns == mtime
+
+    cache.max_bytes = 2500
+    cache.evict()
+    assert os.path.exists(paths[0])       # 刚访问过
+    assert not os.path.exists(paths[1])   # 最久未访问
+    assert os.path.exists(paths[2])
@@ -0,0 +1,33 @@
+import pytest
+
+from conftest import wm
+
+def _ink(text, size):
+    return wm.text_layout(text, wm.get_font_path("Arial"), size).ink
+
+@pytest.mark.parametrize("text, size", [("© Your Name", 24), ("Hello", 36), ("g", 80)])
+def test_drag_to_top_left_never_produces_anchor_values(text, size):
+    ink = _ink(text, size)
+    x, y = wm.clamp_position(-500, -500, 800, 600, ink)
+    assert (x, y) == (0, 0)
+
+def test_drag_to_bottom_right_keeps_ink_inside():
+    ink = _ink("Hello", 36)
+    x, y = wm.clamp_position(10 ** 6, 10 ** 6, 800, 600, ink)
+    assert x + ink[2] == 800 and y + ink[3] == 600
+
+def test_anchor_positions():
+    ink = (2, 5, 102, 35)
+    assert wm.resolve_position(-1, -1, 800, 600, ink) == ((800 - 100) // 2 - 2, (600 - 30) // 2 - 5)
+    assert wm.resolve_position(-2, -2, 800, 600, ink) == (800 - 10 - 102, 600 - 10 - 35)
+    assert wm.resolve_position(0, 0, 800, 600, ink) == (0, 0)
+
+def test_auto_marker_is_not_a_coordinate():
+    settings = {"text": "A", "font_name": "Arial", "font_size": 20, "text_color": "0,0,0", "outline_color": "0,0,0",
+                "alpha": 50, "style": "无"}
+    assert wm.compile_render_plan(dict(settings, pos_x="auto", pos_y="auto")).adaptive
+    dragged = wm.compile_render_plan(dict(settings, pos_x=-3, pos_y=-3))
+    assert not dragged.adaptive
+    assert wm.compile_render_plan(dict(settings, pos_x="auto", pos_y=5)).scaled(0.5).pos_x == "auto"
+    with pytest.raises(ValueError):
+        wm.compile_render_plan(dict(settings, pos_x="left", pos_y=5))
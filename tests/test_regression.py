@@ -0,0 +1,218 @@
+"""
+回归检查：固定语料 × 所有样式/锚点/格式/混合模式，与整图图层的参考实现逐像素比较，
+并检查 EXIF 保留、图章缓存和代理图预览。耗时门槛都相对于同一次运行中参考实现的耗时，不依赖机器速度。
+设置环境变量 WATERMARK_GOLDEN_DIR 时与其中 golden.json 保存的输出摘要比较（不存在时生成）。
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import tracemalloc
+
+import numpy as np
+import piexif
+import pytest
+from PIL import Image, ImageDraw, ImageFont
+
+from conftest import wm, base_settings, CORPUS_SIZE
+
+MAX_DIFF_BLEND = 2      # 正片叠底/滤色：定点运算与浮点参考的最大误差（"正常" 模式要求逐字节一致）
+MIN_SPEEDUP = 1.5       # 区域合成至少比整图图层合成快 50%
+MAX_RENDER_RATIO = 1.2  # 完整渲染（解码 + 合成）不明显慢于参考实现；PNG 解码占大头，留出计时噪声余量
+MAX_PROXY_RATIO = 0.1   # 缓存命中后的代理图预览不超过完整渲染耗时的 1/10
+MAX_PEAK_RATIO = 2.0    # 渲染时的峰值内存增量不超过解码后 RGBA 图片大小的 2 倍
+PROXY_OFFSET_PX = 12    # 代理图中水印中心的偏差（像素）；靠右/靠下的 10 像素边距不随比例缩放
+REPEAT = 5
+
+EXIF_TAGS = (("0th", piexif.ImageIFD.Make), ("0th", piexif.ImageIFD.Model),
+             ("0th", piexif.ImageIFD.Orientation), ("Exif", piexif.ExifIFD.DateTimeOriginal))
+ANCHORS = ((-1, -1), (-2, -2), (-1, -2), (10, 10), (37.5, 21.25))
+SOURCES = ("exif.jpg", "gray.jpg", "rgb.png", "alpha.png")
+
+def _cases():
+    for name in SOURCES:
+        for fmt in ("jpg", "png"):
+            for style in wm.WATERMARK_STYLES:
+                for pos_x, pos_y in ANCHORS:
+                    yield pytest.param(name, fmt, base_settings(style=style, pos_x=pos_x, pos_y=pos_y),
+                                       id=f"{name}-{fmt}-{style}-{pos_x},{pos_y}")
+        for mode in wm.BLEND_MODES[1:]:
+            yield pytest.param(name, "png", base_settings(style="描边", pos_x=-1, pos_y=-1, blend_mode=mode), id=f"{name}-png-{mode}")
+        yield pytest.param(name, "jpg", base_settings(text="© Regress\n第二行", font_size="6%", pos_x=-2, pos_y=-2),
+                           id=f"{name}-jpg-多行+相对字号")
+        yield pytest.param(name, "jpg", base_settings(pos_x=wm.AUTO_POSITION, pos_y=wm.AUTO_POSITION), id=f"{name}-jpg-自动位置")
+
+def _reference_ink(text, font):
+    """在足够大的画布上绘制文字后取实际墨迹范围（不使用排版缓存）。"""
+    left, top, right, bottom = ImageDraw.Draw(Image.new("L", (1, 1))).textbbox((0, 0), text, font=font)
+    pad = 8
+    canvas = Image.new("L", (int(right - left) + 2 * pad, int(bottom - top) + 2 * pad))
+    ImageDraw.Draw(canvas).text((pad - left, pad - top), text, font=font, fill=255)
+    ink = canvas.getbbox() or (pad, pad, pad, pad)
+    return (ink[0] - pad + left, ink[1] - pad + top, ink[2] - pad + left, ink[3] - pad + top)
+
+def reference_watermark(source, settings, text, keep_alpha):
+    """
+    参考实现：整图转 RGBA、新建同尺寸透明图层绘制文字、整图合成（最初 add_watermark 的做法）。
+    对齐位置按规则独立计算；正片叠底/滤色用浮点公式。source 为已打开的源图，返回合成后未编码的图片。
+    """
+    base = source.convert("RGBA")
+    width, height = base.size
+    font = ImageFont.truetype(wm.get_font_path(settings["font_name"]), settings["font_size"])
+    ink = _reference_ink(text, font)
+    pos = []
+    for value, size, lo, hi in ((settings["pos_x"], width, ink[0], ink[2]), (settings["pos_y"], height, ink[1], ink[3])):
+        if value == -1: pos.append((size - (hi - lo)) // 2 - lo)
+        elif value == -2: pos.append(size - 10 - hi)
+        else: pos.append(value)
+    opacity = int(settings["alpha"] * 255 / 100)
+    layer = Image.new("RGBA", base.size, (255, 255, 255, 0))
+    wm._draw_watermark_text(ImageDraw.Draw(layer), tuple(pos), text, font, wm.parse_color(settings["text_color"]) + (opacity,),
+                            settings["style"], wm.parse_color(settings["outline_color"]) + (opacity,))
+    mode = settings.get("blend_mode", "正常")
+    if mode == "正常":
+        result = Image.alpha_composite(base, layer)
+    else:
+        dst = np.asarray(base, dtype=np.float64) / 255; src = np.asarray(layer, dtype=np.float64) / 255
+        cb, ab, cs, a_s = dst[..., :3], dst[..., 3:], src[..., :3], src[..., 3:]
+        mixed = cb * cs if mode == "正片叠底" else cb + cs - cb * cs
+        cs = (1 - ab) * cs + ab * mixed
+        out_a = a_s + ab * (1 - a_s)
+        out_c = np.where(out_a > 0, (a_s * cs + ab * (1 - a_s) * cb) / np.maximum(out_a, 1e-12), cb)
+        out = np.where(a_s > 0, np.concatenate([out_c, out_a], axis=-1), dst)
+        result = Image.fromarray(np.rint(out * 255).astype(np.uint8), "RGBA")
+    return result if keep_alpha else result.convert("RGB")
+
+def _concrete(plan, settings, src, text):
+    """相对字号/自动位置本身是启发式选择，这里按实现选出的具体设置与参考实现比较。"""
+    if not plan.adaptive:
+        return plan, settings
+    decoded = wm._decode_source(src)[0]
+    plan = plan.for_image(decoded.width, decoded.height, text, lambda: wm.luminance_proxy(decoded))
+    return plan, dict(settings, font_size=plan.font_size, pos_x=plan.pos_x, pos_y=plan.pos_y)
+
+class PeakMemory:
+    """峰值内存增量：后台线程采样 RSS（Pillow 的图像缓冲区不经过 Python 分配器），同时用 tracemalloc 记录 Python/NumPy 部分。"""
+    def __enter__(self):
+        self.rss_peak = self.rss_base = self._rss()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True) if self.rss_base is not None else None
+        tracemalloc.start()
+        if self._thread: self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        _, py_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        if self._thread: self._stop.set(); self._thread.join()
+        rss = (self.rss_peak - self.rss_base) if self.rss_base is not None else 0
+        self.peak = max(rss, py_peak)
+
+    @staticmethod
+    def _rss():
+        try:
+            with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _sample(self):
+        while not self._stop.wait(0.0005):
+            self.rss_peak = max(self.rss_peak, self._rss() or 0)
+
+def best_time(func, repeat=REPEAT):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter(); func(); best = min(best, time.perf_counter() - start)
+    return best
+
+@pytest.fixture(scope="session")
+def golden():
+    """WATERMARK_GOLDEN_DIR/golden.json 存在时返回其内容；不存在时收集本次的摘要，结束后写入。"""
+    golden_dir = os.environ.get("WATERMARK_GOLDEN_DIR")
+    path = os.path.join(golden_dir, "golden.json") if golden_dir else None
+    if path and os.path.exists(path):
+        with open(path, encoding="utf-8") as f: yield {"expected": json.load(f), "actual": {}}
+        return
+    state = {"expected": {}, "actual": {}}
+    yield state
+    if path:
+        os.makedirs(golden_dir, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f: json.dump(state["actual"], f, ensure_ascii=False, indent=1)
+
+@pytest.mark.parametrize("name, fmt, settings", list(_cases()))
+def test_matches_reference(corpus, tmp_path, golden, request, name, fmt, settings):
+    src = corpus[name]
+    plan = wm.compile_render_plan(settings, fmt)
+    text = plan.resolve_text(src)
+    plan, settings = _concrete(plan, settings, src, text)
+    img, exif_bytes = plan.render(src, text)
+    with Image.open(src) as source:
+        expected = reference_watermark(source, settings, text, keep_alpha=src.endswith(".png"))
+
+    diff = np.abs(np.asarray(img, dtype=np.int16) - np.asarray(expected, dtype=np.int16))
+    assert int(diff.max()) <= (0 if plan.blend_mode == "正常" else MAX_DIFF_BLEND)
+
+    out_path = str(tmp_path / f"out.{fmt}")
+    plan.save(img, exif_bytes, out_path)
+    if fmt == "jpg" and name == "exif.jpg":
+        source_exif, output_exif = piexif.load(src), piexif.load(out_path)
+        for ifd, tag in EXIF_TAGS:
+            assert output_exif[ifd].get(tag) == source_exif[ifd].get(tag)
+
+    digest = hashlib.sha256(img.tobytes()).hexdigest()
+    golden["actual"][request.node.callspec.id] = digest
+    if request.node.callspec.id in golden["expected"]:
+        assert golden["expected"][request.node.callspec.id] == digest
+
+@pytest.mark.parametrize("name", SOURCES)
+@pytest.mark.parametrize("style", ("无", "描边"))
+def test_performance_budget(corpus, name, style):
+    """区域合成与整图图层合成在同一次运行中计时比较，完整渲染和峰值内存也按相对门槛检查。"""
+    src = corpus[name]
+    settings = base_settings(style=style, pos_x=-2, pos_y=-2)
+    plan = wm.compile_render_plan(settings, "jpg")
+    text = plan.text
+    decoded, _, _, keep_alpha = wm._decode_source(src)
+    with Image.open(src) as source:
+        source.load()
+        fast = best_time(lambda: plan.apply(decoded.copy(), text))
+        reference = best_time(lambda: reference_watermark(source, settings, text, keep_alpha))
+    assert reference / fast >= MIN_SPEEDUP
+
+    def reference_render():
+        with Image.open(src) as source: reference_watermark(source, settings, text, keep_alpha)
+    assert best_time(lambda: plan.render(src, text)) <= best_time(reference_render) * MAX_RENDER_RATIO
+
+    with PeakMemory() as memory: plan.render(src, text)
+    assert memory.peak <= CORPUS_SIZE[0] * CORPUS_SIZE[1] * 4 * MAX_PEAK_RATIO
+
+def test_stamp_cache_hit_matches_cold_render(corpus):
+    plan = wm.compile_render_plan(base_settings(text="© Cache", style="描边", pos_x=-2, pos_y=-2), "png")
+    wm.render_stamp.cache_clear()
+    cold = plan.render(corpus["rgb.png"])[0].tobytes()
+    hits = wm.render_stamp.cache_info().hits
+    warm = plan.render(corpus["rgb.png"])[0].tobytes()
+    assert wm.render_stamp.cache_info().hits > hits
+    assert cold == warm
+
+@pytest.mark.parametrize("pos_x, pos_y", ANCHORS[:3])
+def test_proxy_preview(corpus, pos_x, pos_y):
+    """代理图预览的耗时相对于完整渲染，水印中心位置与按比例换算的原图位置一致。"""
+    src = corpus["rgb.png"]
+    plan = wm.compile_render_plan(base_settings(text="© Cache", font_size=30, style="描边", pos_x=pos_x, pos_y=pos_y))
+    proxies = wm.ByteLRUCache(64 * 1024 * 1024, sizeof=lambda item: wm._image_nbytes(item[0]))
+    wm.render_proxy(src, plan, (160, 120), proxies)
+    elapsed = best_time(lambda: wm.render_proxy(src, plan, (160, 120), proxies))
+    assert elapsed <= best_time(lambda: plan.render(src)) * MAX_PROXY_RATIO
+
+    full = np.asarray(plan.render(src)[0].convert("L"), dtype=np.int16)
+    with Image.open(src) as original: plain = np.asarray(original.convert("L"), dtype=np.int16)
+    proxy = np.asarray(wm.render_proxy(src, plan, (160, 120), proxies).convert("L"), dtype=np.int16)
+    small = np.asarray(proxies.get(src)[0].convert("L"), dtype=np.int16)
+    centres = []
+    for marked, clean in ((full, plain), (proxy, small)):
+        ys, xs = np.nonzero(marked != clean)
+        assert len(xs)
+        centres.append((xs.mean() * small.shape[1] / clean.shape[1], ys.mean() * small.shape[0] / clean.shape[0]))
+    assert max(abs(centres[0][0] - centres[1][0]), abs(centres[0][1] - centres[1][1])) <= PROXY_OFFSET_PX
@@ -0,0 +1,26 @@
+import io
+
+import piexif
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings, CORPUS_EXIF
+
+def test_same_settings_compile_once():
+    assert wm.compile_render_plan(base_settings(), "jpg") is wm.compile_render_plan(base_settings(), "JPG")
+
+def test_invalid_settings_fail_up_front():
+    with pytest.raises(ValueError):
+        wm.compile_render_plan(base_settings(text_color="white"), "jpg")
+    with pytest.raises(ValueError):
+        wm.compile_render_plan(base_settings(), "gif")
+
+@pytest.mark.parametrize("output_format, expected, mode, has_exif", [("jpg", "JPEG", "RGB", True), ("png", "PNG", "RGBA", False)])
+def test_save_uses_the_plan_encoder(output_format, expected, mode, has_exif):
+    plan = wm.compile_render_plan(base_settings(), output_format)
+    assert plan.encoder == wm.encoder_for(output_format)
+    buffer = io.BytesIO()
+    plan.save(Image.new("RGBA", (40, 30), (10, 20, 30, 200)), piexif.dump(CORPUS_EXIF), buffer)
+    with Image.open(io.BytesIO(buffer.getvalue())) as saved:
+        assert saved.format == expected and saved.mode == mode
+        assert ("exif" in saved.info) == has_exif
@@ -0,0 +1,40 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings
+
+def test_template_rendition_defaults_to_job_format():
+    templates = {"small": base_settings(text="© Small")}
+    resolved = wm.resolve_renditions([{"template": "small"}, {"template": "small", "format": "jpg"}], templates, "png")
+    assert resolved[0]["plan"].output_format == "png"
+    assert resolved[1]["plan"].output_format == "jpg"
+
+def test_full_size_rendition_matches_single_render(corpus, tmp_path):
+    plan = wm.compile_render_plan(base_settings(pos_x=-2, pos_y=-2), "png")
+    single = wm.render_file(corpus["exif.jpg"], plan, str(tmp_path), "保持原名", "")
+    versions_dir = tmp_path / "versions"
+    versions_dir.mkdir()
+    [version] = wm.render_renditions(corpus["exif.jpg"], plan, [{}], str(versions_dir), "保持原名", "")
+    with Image.open(single) as a, Image.open(version) as b:
+        assert a.mode == b.mode == "RGB"
+        assert np.array_equal(np.asarray(a), np.asarray(b))
+
+def test_oversized_source_skips_bomb_check(tmp_path, monkeypatch):
+    src = str(tmp_path / "wide.jpg")
+    Image.new("RGB", (2000, 1500), (90, 120, 150)).save(src)
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100_000)  # 超过两倍上限，普通 Image.open 会拒绝
+    plan = wm.compile_render_plan(base_settings(), "jpg")
+    out_paths = wm.render_renditions(src, plan, [{}, {"max_size": 100}], str(tmp_path), "添加后缀", "_v")
+    assert len(out_paths) == 2 and all(os.path.exists(p) for p in out_paths)
+    assert Image.MAX_IMAGE_PIXELS == 100_000
+
+def test_oversized_source_over_budget_is_refused(tmp_path, monkeypatch):
+    src = str(tmp_path / "wide.jpg")
+    Image.new("RGB", (1200, 900), (90, 120, 150)).save(src)
+    monkeypatch.setattr(wm, "MEMORY_BUDGET_MB", 2)  # 单份解码约 3 MB
+    plan = wm.compile_render_plan(base_settings(), "jpg")
+    with pytest.raises(wm.MemoryBudgetError):
+        wm.render_renditions(src, plan, [{}, {"max_size": 300}], str(tmp_path), "添加后缀", "_v")
@@ -0,0 +1,55 @@
+import os
+import sys
+import subprocess
+
+from PIL import Image
+
+from conftest import wm, base_settings, ROOT
+
+def _image(path, size):
+    Image.new("RGB", size, "gray").save(path)
+    return str(path)
+
+def test_schedule_longest_first_grouped_by_folder():
+    costs = {"/b/x.jpg": 1000, "/a/y.jpg": 1100, "/a/big.jpg": 10 ** 6, "/a/x.jpg": 1050}
+    order = wm.schedule_batch(costs)
+    assert order[0] == "/a/big.jpg"
+    # 同一档（2 的幂）内按文件夹、文件名排列
+    assert order[1:] == ["/a/x.jpg", "/a/y.jpg", "/b/x.jpg"]
+
+def test_estimate_cost_grows_with_pixels_and_renditions(tmp_path):
+    plan = wm.compile_render_plan(base_settings())
+    small = wm.estimate_cost(_image(tmp_path / "s.jpg", (100, 100)), plan)
+    large = wm.estimate_cost(_image(tmp_path / "l.jpg", (1000, 1000)), plan)
+    assert large > small
+    both = wm.estimate_cost(str(tmp_path / "l.jpg"), plan, [{"max_size": None}, {"max_size": 200}])
+    assert both > large
+
+def test_estimate_cost_unreadable_file(tmp_path):
+    path = tmp_path / "bad.jpg"
+    path.write_bytes(b"not an image")
+    assert wm.estimate_cost(str(path), wm.compile_render_plan(base_settings())) == wm._TASK_OVERHEAD_NS
+
+def test_run_batch_processes_every_file(tmp_path):
+    plan = wm.compile_render_plan(base_settings())
+    inputs = [_image(tmp_path / f"{i}.jpg", (120 + i * 40, 90)) for i in range(4)]
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    results = wm.run_batch({p: plan for p in inputs}, str(out_dir), workers=1)
+    assert sorted(results) == sorted(inputs)
+    assert sorted(os.listdir(out_dir)) == sorted(os.path.basename(p) for p in inputs)
+
+def test_cli_batch_rejects_output_equal_to_input(tmp_path):
+    photos = tmp_path / "photos"
+    photos.mkdir()
+    src = _image(photos / "a.jpg", (50, 50))
+    before = open(src, "rb").read()
+    templates = str(tmp_path / "templates")
+    for target in (str(photos), src):
+        # 在临时目录中运行，模板存储也放在临时目录，不在仓库中生成文件
+        result = subprocess.run([sys.executable, os.path.join(ROOT, "WaterMark2.Final.py"), "--templates-file", templates,
+                                 "--batch", target, "--output", str(photos)],
+                                capture_output=True, text=True, timeout=60, cwd=str(tmp_path))
+        assert result.returncode != 0 and "不能和原文件夹相同" in result.stderr
+    assert open(src, "rb").read() == before
+    assert not os.path.exists(templates)  # 参数检查在打开模板存储之前
@@ -0,0 +1,82 @@
+import http.client
+import io
+import json
+import struct
+import threading
+import zlib
+
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings
+
+@pytest.fixture(scope="module")
+def service():
+    service = wm.RenderService({"默认模板 (右下角阴影)": base_settings()}, port=0, workers=1)
+    thread = threading.Thread(target=service.httpd.serve_forever, daemon=True)
+    thread.start()
+    yield service
+    service.shutdown()
+    service.close()
+    thread.join()
+
+def post(service, path, body, headers=None):
+    conn = http.client.HTTPConnection(*service.address, timeout=30)
+    try:
+        conn.request("POST", path, body=body, headers=headers or {})
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def jpeg_bytes():
+    buffer = io.BytesIO()
+    Image.new("RGB", (160, 120), (90, 120, 150)).save(buffer, "JPEG")
+    return buffer.getvalue()
+
+def test_render_ok(service):
+    status, body = post(service, "/render?format=png", jpeg_bytes())
+    assert status == 200
+    assert Image.open(io.BytesIO(body)).format == "PNG"
+
+def test_unreadable_image_is_client_error(service):
+    status, _ = post(service, "/render", b"definitely not an image")
+    assert status == 400
+
+def test_missing_template_message_is_plain(service):
+    status, body = post(service, "/render?template=nope", jpeg_bytes())
+    assert status == 400
+    assert body.decode("utf-8") == "未找到模板 'nope'\n"
+
+@pytest.mark.parametrize("raw", ["[]", "\"text\"", "42"])
+def test_non_object_settings_header_is_client_error(service, raw):
+    status, body = post(service, "/render?text=hi", jpeg_bytes(), {"X-Watermark-Settings": raw})
+    assert status == 400
+    assert "JSON 对象" in body.decode("utf-8")
+
+def test_invalid_settings_json_is_client_error(service):
+    status, _ = post(service, "/render", jpeg_bytes(), {"X-Watermark-Settings": json.dumps({"text": "x"})})
+    assert status == 400
+
+def test_negative_content_length_is_rejected_without_reading(service):
+    conn = http.client.HTTPConnection(*service.address, timeout=5)
+    try:
+        conn.putrequest("POST", "/render")
+        conn.putheader("Content-Length", "-1")
+        conn.endheaders()
+        response = conn.getresponse()
+        assert response.status == 400
+    finally:
+        conn.close()
+    status, _ = post(service, "/render", jpeg_bytes())
+    assert status == 200  # 并发名额已释放
+
+def _png_chunk(chunk_type, data):
+    return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+def test_decompression_bomb_is_client_error(service):
+    # 只有文件头声明 20000×20000，超过 Pillow 的像素上限
+    bomb = (b"\x89PNG\r\n\x1a\n" + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", 20000, 20000, 8, 2, 0, 0, 0))
+            + _png_chunk(b"IDAT", zlib.compress(b"")) + _png_chunk(b"IEND", b""))
+    status, _ = post(service, "/render", bomb)
+    assert status == 400
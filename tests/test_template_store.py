@@ -0,0 +1,91 @@
+import os
+import json
+import pickle
+import multiprocessing
+
+from conftest import wm
+
+def _writer(args):
+    directory, worker = args
+    store = wm.TemplateStore(directory)
+    for i in range(10):
+        store[f"w{worker}_{i}"] = {"i": i}
+        store["shared"] = {"worker": worker, "i": i}
+    return worker
+
+def test_mapping_api_and_persistence(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    store["a"] = {"text": "A"}
+    store["b"] = {"text": "B"}
+    del store["b"]
+    assert "b" not in store and len(store) == 1
+    reopened = wm.TemplateStore(str(tmp_path / "store"))
+    assert dict(reopened) == {"a": {"text": "A"}}
+
+def test_writes_leave_no_temp_files(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    for i in range(5): store["t"] = {"i": i}
+    assert not [n for n in os.listdir(tmp_path / "store") if n.endswith(".tmp")]
+
+def test_history_and_restore(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    for value in "ABC": store["t"] = {"v": value}
+    assert store.history("t") == [1, 2]
+    assert store.version("t", 1) == {"v": "A"}
+    store.restore("t", 1)
+    assert store["t"] == {"v": "A"} and store.history("t") == [1, 2, 3]
+
+def test_recreated_template_keeps_counting_versions(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    store["t"] = {"v": "A"}
+    store["t"] = {"v": "B"}
+    del store["t"]
+    store["t"] = {"v": "C"}
+    store["t"] = {"v": "D"}
+    assert store.history("t") == [1, 2, 3]
+    assert [store.version("t", v) for v in (1, 2, 3)] == [{"v": "A"}, {"v": "B"}, {"v": "C"}]
+    assert store._index["t"]["version"] == 4
+
+def test_session_entries_keep_no_history(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    store["__last_session__"] = {"v": 1}
+    store["__last_session__"] = {"v": 2}
+    assert store.history("__last_session__") == []
+
+def test_history_is_capped(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    for i in range(wm.TEMPLATE_HISTORY_LIMIT + 5): store["t"] = {"i": i}
+    assert len(store.history("t")) == wm.TEMPLATE_HISTORY_LIMIT
+
+def test_sees_writes_from_another_instance(tmp_path):
+    first = wm.TemplateStore(str(tmp_path / "store"))
+    second = wm.TemplateStore(str(tmp_path / "store"))
+    first["t"] = {"v": 1}
+    assert second["t"] == {"v": 1}
+    first["t"] = {"v": 2}
+    assert second["t"] == {"v": 2}
+
+def test_pickles_as_directory(tmp_path):
+    store = wm.TemplateStore(str(tmp_path / "store"))
+    store["t"] = {"v": 1}
+    assert pickle.loads(pickle.dumps(store))["t"] == {"v": 1}
+
+def test_concurrent_writers_lose_nothing(tmp_path):
+    directory = str(tmp_path / "store")
+    wm.TemplateStore(directory)
+    with multiprocessing.get_context("fork").Pool(4) as pool:
+        pool.map(_writer, [(directory, w) for w in range(4)])
+    store = wm.TemplateStore(directory)
+    assert len(store) == 41
+    assert len(store.history("shared")) == wm.TEMPLATE_HISTORY_LIMIT
+    assert max(store.history("shared")) == 39
+
+def test_migrates_legacy_file_once_and_keeps_it(tmp_path):
+    legacy = tmp_path / "watermark_templates.json"
+    legacy.write_text(json.dumps({"t": {"v": 1}, "__last_session__": {"v": 0}}), encoding="utf-8")
+    store = wm.load_templates(str(legacy))
+    assert dict(store) == {"t": {"v": 1}, "__last_session__": {"v": 0}}
+    assert legacy.exists()
+    store["t"] = {"v": 2}
+    legacy.write_text(json.dumps({"t": {"v": 99}}), encoding="utf-8")
+    assert wm.load_templates(str(legacy))["t"] == {"v": 2}
@@ -0,0 +1,47 @@
+import os
+import sys
+import subprocess
+
+import pytest
+from PIL import Image
+
+from conftest import wm, base_settings, ROOT
+
+def _run_cli(tmp_path, *args):
+    """在临时目录中运行命令行，模板存储也放在临时目录，不在仓库中生成文件。"""
+    templates = str(tmp_path / "templates")
+    return subprocess.run([sys.executable, os.path.join(ROOT, "WaterMark2.Final.py"), "--templates-file", templates, *args],
+                          capture_output=True, text=True, timeout=60, cwd=str(tmp_path))
+
+def test_watcher_rejects_output_equal_to_input(tmp_path):
+    with pytest.raises(ValueError):
+        wm.FolderWatcher(str(tmp_path), str(tmp_path) + os.sep, base_settings())
+
+def test_cli_watch_rejects_output_equal_to_input(tmp_path):
+    watched = tmp_path / "watched"
+    watched.mkdir()
+    result = _run_cli(tmp_path, "--watch", str(watched), "--output", str(watched))
+    assert result.returncode != 0
+    assert "不能和监视的文件夹相同" in result.stderr
+    assert not (tmp_path / "templates").exists()  # 参数检查在打开模板存储之前
+
+def test_watcher_ignores_files_it_wrote(tmp_path):
+    src_dir, out_dir = tmp_path / "in", tmp_path / "out"
+    src_dir.mkdir(); out_dir.mkdir()
+    src = src_dir / "x.jpg"
+    Image.new("RGB", (100, 80), "gray").save(src)
+    watcher = wm.FolderWatcher(str(src_dir), str(out_dir), base_settings())
+    signature = watcher._signature(str(src))
+    watcher._in_flight.add(str(src))
+    watcher._process(str(src), signature, 0)
+    out_path = str(out_dir / "x.jpg")
+    assert os.path.exists(out_path)
+    submitted = []
+    watcher.executor.submit = lambda *args: submitted.append(args)
+    watcher.submit(out_path)
+    assert not submitted
+    watcher.submit(str(src))  # 原图未变，不重复处理
+    assert not submitted
+    Image.new("RGB", (100, 80), "white").save(src)
+    watcher.submit(str(src))
+    assert len(submitted) == 1